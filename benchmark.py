@@ -0,0 +1,713 @@
+# Cycle-time benchmark for the test sequence.
+#
+# Runs parts of the test sequence against a simulated fixture, which
+# injects a fixed latency into every hardware round trip. For each scenario
+# the wall time, number of hardware round trips and number of ADC samples
+# are reported, and compared against a stored baseline.
+#
+# The simulated fixture does not model the analog behaviour of the EUT, so
+# limit checks are evaluated but not enforced. Digital responses (register
+# contents, USB descriptors, command output) are modelled well enough for
+# the sequence to run to completion.
+
+from contextlib import contextmanager, redirect_stdout
+from time import perf_counter, sleep
+from tycho import gpio_allocations
+from registers import *
+import argparse
+import asyncio
+import engine
+import importlib
+import json
+import io
+import os
+import subprocess
+import sys
+import tps55288
+from fixture import Fixture, fixture, use
+from errors import GF1Error
+import tests
+
+BASELINE = 'benchmark.json'
+
+# Budget for the start-up cost of importing each test entry point, in ms.
+IMPORT_BUDGET = 150
+ENTRY_POINTS = ('cynthion-test', 'daemon', 'calibrate')
+
+# Time for the gateware to poll the power monitor over I2C, in seconds. Each
+# register read takes about 235us, and the refresh write about 100us.
+POWER_MONITOR_POLL_TIME = 100e-6 + 1e-3 + 8 * 235e-6
+
+class SimulatedHardware:
+    def __init__(self, latency, sample_time, enumeration_time, command_time):
+        self.latency = latency
+        self.sample_time = sample_time
+        self.enumeration_time = enumeration_time
+        self.command_time = command_time
+        self.levels = {}
+        self.registers = {}
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.round_trips = 0
+        self.adc_samples = 0
+
+    def transaction(self, duration=0.0):
+        self.round_trips += 1
+        sleep(self.latency + duration)
+
+class SimulatedPin:
+    def __init__(self, hw, name):
+        self.hw = hw
+        self.name = name
+
+    def high(self):
+        self.write(True)
+
+    def low(self):
+        self.write(False)
+
+    def write(self, high):
+        self.hw.transaction()
+        self.hw.levels[self.name] = bool(high)
+
+    def input(self):
+        self.hw.transaction()
+        self.hw.levels[self.name] = None
+        sbu = self.hw.registers.get('sbu', 0)
+        if self.name == 'SBU1_test':
+            return bool(sbu & 0b01)
+        if self.name == 'SBU2_test':
+            return bool(sbu & 0b10)
+        # Inputs with pull-ups, including the PASS and FAIL buttons.
+        return True
+
+class SimulatedGPIO:
+    def __init__(self, hw):
+        self.hw = hw
+        self.names = {position: name
+            for name, (position, output) in gpio_allocations.items()}
+        # Lines are numbered in allocation order, on a single port.
+        self.pin_mappings = {position: (0, index)
+            for index, position in enumerate(self.names)}
+
+    def get_pin(self, position):
+        self.hw.transaction()
+        return SimulatedPin(self.hw, self.names[position])
+
+class SimulatedADC:
+    def __init__(self, hw):
+        self.hw = hw
+
+    def read_samples(self, count):
+        self.hw.adc_samples += count
+        self.hw.transaction(count * self.hw.sample_time)
+        return [0] * count
+
+class SimulatedFrequencyCounter:
+    def __init__(self, hw):
+        self.hw = hw
+
+    def setup_counters(self, reference_hz):
+        self.hw.transaction()
+
+    def count_cycles(self):
+        self.hw.transaction()
+        return 6000000
+
+class SimulatedGPIOAPI:
+    def __init__(self, hw):
+        self.hw = hw
+        self.names = [name for name in gpio_allocations]
+
+    def write_pins(self, *writes):
+        self.hw.transaction()
+        for port, line, state in writes:
+            self.hw.levels[self.names[line]] = bool(state)
+
+class SimulatedAPIs:
+    def __init__(self, hw):
+        self.freq_count = SimulatedFrequencyCounter(hw)
+        self.gpio = SimulatedGPIOAPI(hw)
+
+class SimulatedGreatFET:
+    def __init__(self, hw):
+        self.hw = hw
+        self.gpio = SimulatedGPIO(hw)
+        self.adc = SimulatedADC(hw)
+        self.apis = SimulatedAPIs(hw)
+        self.i2c = None
+
+    def serial_number(self):
+        self.hw.transaction()
+        return 'SIMULATED'
+
+    def firmware_version(self):
+        self.hw.transaction()
+        return "git-v2025.0.0-1-g78c06b4"
+
+class SimulatedButtons:
+    # The real watcher samples the buttons in the background, which would
+    # add round trips that the test sequence does not wait for. No button
+    # is ever pressed.
+    def __init__(self, gf, pass_pin, fail_pin):
+        pass
+
+    def clear(self):
+        pass
+
+    def wait(self, timeout=None):
+        return 'PASS'
+
+    def check(self):
+        pass
+
+    def stop(self):
+        pass
+
+class SimulatedTPS55288(tps55288.TPS55288):
+    def __init__(self, hw):
+        self.hw = hw
+
+    def read(self, reg):
+        self.check_enabled()
+        return 0b11100000 if reg == tps55288.CDC else 0
+
+    def write(self, reg, value):
+        self.check_enabled()
+
+    def check_enabled(self):
+        # The converter does not answer on I2C while shut down.
+        self.hw.transaction()
+        if not self.hw.levels.get('BOOST_EN'):
+            raise GF1Error("I2C transaction to DC-DC converter was not acknowledged")
+
+class SimulatedRegisters:
+    # ULPI register contents for the USB3343 PHYs.
+    phy_ids = {0: 0x24, 1: 0x04, 2: 0x09, 3: 0x00}
+
+    # Expected D+/D- levels for each ULPI function control & IO setting.
+    sense = {(0x41, 0x06): (0, 0), (0x45, 0x04): (0, 1), (0x45, 0x06): (1, 0)}
+
+    def __init__(self, hw, jtag):
+        self.hw = hw
+        self.jtag = jtag
+        self.values = {REGISTER_ID: 0x54455354}
+        self.phy = {}
+
+    def register_write(self, reg, value):
+        with self.jtag:
+            self.hw.transaction()
+        self.values[reg] = value
+        if reg == REGISTER_RAM_BIST:
+            self.values['ram_bist_started'] = perf_counter()
+        if reg in (REGISTER_AUX_SBU, REGISTER_TARGET_SBU):
+            self.hw.registers['sbu'] = value
+        for base in (REGISTER_CONTROL_ADDR, REGISTER_AUX_ADDR, REGISTER_TARGET_ADDR):
+            if reg == base + 1:
+                address = self.values.get(base, 0)
+                self.phy[(base, address)] = value
+
+    def register_read(self, reg):
+        with self.jtag:
+            self.hw.transaction()
+        for base, port in (
+                (REGISTER_CONTROL_ADDR, 'BOOST_VBUS_CON'),
+                (REGISTER_AUX_ADDR, 'BOOST_VBUS_AUX'),
+                (REGISTER_TARGET_ADDR, 'BOOST_VBUS_TC')):
+            if reg == base + 1:
+                address = self.values.get(base, 0)
+                if address in self.phy_ids:
+                    return self.phy_ids[address]
+                if address == 0x13:
+                    return 0x04 if self.hw.levels.get(port) else 0
+                return self.phy.get((base, address), 0)
+        if reg in (REGISTER_SENSE_DP, REGISTER_SENSE_DM):
+            func = self.phy.get((REGISTER_TARGET_ADDR, 0x04), 0x41)
+            io = self.phy.get((REGISTER_TARGET_ADDR, 0x39), 0x06)
+            dp, dm = self.sense.get((func, io), (0, 0))
+            return dp if reg == REGISTER_SENSE_DP else dm
+        if reg == REGISTER_DPDM_SENSE:
+            # The sequencer applies each configuration in turn.
+            status = 0x40
+            for index, (dp, dm) in enumerate(self.sense.values()):
+                status |= (dp | dm << 1) << (2 * index)
+            return status
+        if reg == REGISTER_RAM_VALUE:
+            return 0x0c81
+        if reg == REGISTER_RAM_BIST:
+            # The whole test takes ~0.33s.
+            started = self.values.get('ram_bist_started', 0)
+            return 0b11 if perf_counter() - started > 0.33 else 0
+        if reg in (REGISTER_RAM_BIST_WRITE_CYCLES, REGISTER_RAM_BIST_READ_CYCLES):
+            return 4_900_000
+        if reg in (REGISTER_CONTROL_SPEED_CHECKED, REGISTER_AUX_SPEED_CHECKED,
+                   REGISTER_TARGET_SPEED_CHECKED):
+            # Three runs of 1MB, plus the transfers left to complete.
+            return 3 * (1024 * 1024 + 16 * 0x7FFF)
+        if reg == REGISTER_PMOD_BIST:
+            # Completed and passed, with no mismatches.
+            return 0x300
+        if reg == REGISTER_PWR_MON_SAMPLES:
+            # The gateware polls the power monitor back to back: a refresh
+            # write, 1ms to settle, then eight register reads.
+            return int(perf_counter() / POWER_MONITOR_POLL_TIME) & 0xFFFF
+        address = self.values.get(reg - 1, 0) >> 8
+        if reg in (REGISTER_AUX_TYPEC_CTL_VALUE, REGISTER_TARGET_TYPEC_CTL_VALUE):
+            return 0b10000000 if address == 0x01 else 0
+        if reg == REGISTER_PWR_MON_VALUE:
+            return 0x54 if address == 0xFE else 0
+        return self.values.get(reg, 0)
+
+class SimulatedJTAGDevice:
+    def idcode(self):
+        return 0x21111043
+
+    def description(self):
+        return "Lattice LFE5U-12F ECP5 FPGA"
+
+class SimulatedJTAG:
+    # Sessions nest as apollo_fpga's do: only the outermost one costs the
+    # requests to start and stop JTAG.
+    def __init__(self, hw):
+        self.hw = hw
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.hw.transaction()
+            self.hw.transaction()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.depth -= 1
+        if self.depth == 0:
+            self.hw.transaction()
+        return False
+
+    def enumerate(self):
+        self.hw.transaction()
+        return [SimulatedJTAGDevice()]
+
+class SimulatedProgrammer:
+    def __init__(self, hw):
+        self.hw = hw
+
+    def unconfigure(self):
+        self.hw.transaction()
+
+    def read_flash_id(self):
+        self.hw.transaction()
+        return 0xEF, 0xEF4016
+
+    def read_flash_uid(self):
+        self.hw.transaction()
+        return 0x0123456789ABCDEF
+
+    def configure(self, bitstream):
+        self.hw.transaction(self.hw.command_time)
+
+    def flash(self, bitstream):
+        self.hw.transaction(self.hw.command_time)
+
+class SimulatedApollo:
+    def __init__(self, hw):
+        self.hw = hw
+        hw.transaction(hw.enumeration_time)
+        self.jtag = SimulatedJTAG(hw)
+        self.registers = SimulatedRegisters(hw, self.jtag)
+
+    def create_jtag_programmer(self, jtag):
+        return SimulatedProgrammer(self.hw)
+
+    def set_led_pattern(self, bitmask):
+        self.hw.transaction()
+
+    def allow_fpga_takeover_usb(self):
+        self.hw.transaction()
+
+    def close(self):
+        pass
+
+class SimulatedHandle:
+    def __init__(self, hw):
+        self.hw = hw
+
+    def claimInterface(self, interface):
+        self.hw.transaction()
+
+    def controlWrite(self, *args):
+        self.hw.transaction()
+
+class SimulatedUSBDevice:
+    strings = {
+        (0x1d50, 0x60e6): ("Great Scott Gadgets", "GreatFET"),
+        (0x1d50, 0x6018): ("Black Magic Debug", "Black Magic Probe v1.9.1"),
+        (0x1d50, 0x615b): ("Cynthion Project", "USB Analyzer"),
+        (0x1209, 0x000f): ("Apollo Project", "Configuration Flash Bridge"),
+        (0x04b4, 0x1003): (None, "Cy-stream"),
+    }
+
+    def __init__(self, hw, vid, pid):
+        self.hw = hw
+        self.vid = vid
+        self.pid = pid
+        # Saturn-V and Apollo share a VID/PID; tell them apart by sequence.
+        if (vid, pid) == (0x1d50, 0x615c):
+            if fixture().mcu_serial in hw.registers.setdefault('mcu', set()):
+                self.names = ("Apollo Project", "Apollo Debugger")
+            else:
+                hw.registers['mcu'].add(fixture().mcu_serial)
+                self.names = ("Saturn-V Project", "Bootloader")
+        elif vid == 0x1209 and pid in (0x0001, 0x0002, 0x0003):
+            self.names = ("LUNA", "speed test")
+        else:
+            self.names = self.strings.get((vid, pid), (None, None))
+
+    def getManufacturer(self):
+        self.hw.transaction()
+        return self.names[0]
+
+    def getProduct(self):
+        self.hw.transaction()
+        return self.names[1]
+
+    def getSerialNumber(self):
+        self.hw.transaction()
+        if (self.vid, self.pid) == (0x1d50, 0x615c):
+            return fixture().mcu_serial
+        if (self.vid, self.pid) == (0x1d50, 0x615b):
+            return hex(fixture().flash_serial)[2:].lower()
+        return "SIMULATED"
+
+    def getBusNumber(self):
+        return 1
+
+    def getDeviceAddress(self):
+        return 1
+
+    def open(self):
+        self.hw.transaction()
+        return SimulatedHandle(self.hw)
+
+class SimulatedProcess:
+    def __init__(self, args, stdout):
+        self.args = args
+        self.returncode = 0
+        self.stdout = stdout
+
+class SimulatedFlashBridge:
+    def __init__(self, hw):
+        hw.transaction()
+
+@contextmanager
+def simulated_fixture(hw, modules):
+    def wait_for_device(vid, pid, timeout):
+        hw.transaction(hw.enumeration_time)
+        return SimulatedUSBDevice(hw, vid, pid)
+
+    def run_command(cmd):
+        hw.transaction(hw.command_time)
+        return SimulatedProcess(cmd.split(" "), b"Serial Number: 0x" + b"0123ABCD" * 4 + b"\n")
+
+    def start_command(cmd):
+        async def simulated_command():
+            await asyncio.sleep(hw.latency + hw.command_time)
+            hw.round_trips += 1
+            return SimulatedProcess(cmd.split(" "), b"Serial Number: 0x" + b"0123ABCD" * 4 + b"\n")
+        return engine.submit(simulated_command())
+
+    def installed(path):
+        return True
+
+    def read_calibration(serial):
+        return dict(fixture().calibration, greatfet_serial='SIMULATED')
+
+    def test_usb_hs_speed_single(port, handle, endpoint, direction='IN', check=False):
+        # Transfer of 1MB at a nominal 45MB/s.
+        hw.transaction(1024 * 1024 / 45e6)
+        return 45.0
+
+    def test_value(qty, src, value, unit, expected, ignore=False):
+        return real_test_value(qty, src, value, unit, expected, ignore=True)
+
+    def open_file(path, *args, **kwargs):
+        if path.startswith('/etc/udev/rules.d/'):
+            path = os.path.basename(path)
+        if path == 'calibration-drift.jsonl':
+            path = os.devnull
+        return open(path, *args, **kwargs)
+
+    real_test_value = tests.test_value
+    replacements = dict(
+        GreatFET=lambda **identifiers: SimulatedGreatFET(hw),
+        ButtonWatcher=SimulatedButtons,
+        TPS55288=lambda gf: SimulatedTPS55288(hw),
+        ApolloDebugger=lambda device=None: SimulatedApollo(hw),
+        pyusb_device=lambda device: None,
+        FlashBridgeConnection=lambda: SimulatedFlashBridge(hw),
+        ECP5FlashBridgeProgrammer=lambda bridge: SimulatedProgrammer(hw),
+        wait_for_device=wait_for_device,
+        run_command=run_command,
+        start_command=start_command,
+        installed=installed,
+        read_calibration=read_calibration,
+        test_usb_hs_speed_single=test_usb_hs_speed_single,
+        test_value=test_value,
+        open=open_file,
+    )
+    saved = []
+    for module in modules:
+        for name, value in replacements.items():
+            saved.append((module, name, module.__dict__.get(name)))
+            setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in reversed(saved):
+            if value is None:
+                delattr(module, name)
+            else:
+                setattr(module, name, value)
+
+def scenario_setup(hw):
+    yield
+    tests.setup()
+
+def scenario_shorts(hw):
+    tests.setup()
+    yield
+    for port in ('CONTROL', 'AUX', 'TARGET-C'):
+        tests.check_for_shorts(port)
+
+def scenario_supply_port(hw):
+    tests.setup()
+    tests.connect_grounds()
+    yield
+    for port in ('CONTROL', 'AUX'):
+        tests.test_supply_port(port)
+
+def scenario_supply_port_adaptive(hw):
+    tests.setup()
+    tests.connect_grounds()
+    tests.fixture().modes = {'adaptive-ovp'}
+    yield
+    for port in ('CONTROL', 'AUX'):
+        tests.test_supply_port(port)
+
+def scenario_leds(hw):
+    tests.setup()
+    apollo = tests.apollo_connection().open(tests.ApolloDebugger())
+    yield
+    tests.test_leds(apollo, "debug", tests.debug_leds, tests.set_debug_leds)
+    tests.test_leds(apollo, "FPGA", tests.fpga_leds, tests.set_fpga_leds)
+
+def scenario_leds_encoded(hw):
+    tests.setup()
+    tests.fixture().modes = {'encoded-leds'}
+    apollo = tests.apollo_connection().open(tests.ApolloDebugger())
+    yield
+    tests.test_leds(apollo, "debug", tests.debug_leds, tests.set_debug_leds)
+    tests.test_leds(apollo, "FPGA", tests.fpga_leds, tests.set_fpga_leds)
+
+def scenario_vbus_distribution(hw):
+    tests.setup()
+    tests.load_calibration()
+    apollo = tests.apollo_connection().open(tests.ApolloDebugger())
+    tests.configure_power_monitor(apollo)
+    yield
+    for (voltage, load_resistance, load_pin) in (
+            ( 6.25, tests.Range(1.782, 1.818), 'TEST_5V' ),
+            (20.00, tests.Range( 39.6,  40.4), 'TEST_20V')):
+        for passthrough in (False, True):
+            for input_port in ('CONTROL', 'AUX'):
+                tests.test_vbus_distribution(
+                    apollo, voltage, load_resistance,
+                    load_pin, passthrough, input_port)
+
+def scenario_calibration_drift(hw):
+    tests.setup()
+    calibration = fixture().calibration
+    # The simulated ADC reads zero, so offset the fit to give references
+    # that can be compared, and a small drift in current.
+    calibration['ranges']['lower']['offset'] = 3.3
+    references = tests.measure_references()
+    calibration['references'] = dict(references, current=references['current'] - 0.005)
+    yield
+    # Correcting for the same drift again must leave the correction as it is.
+    offsets = []
+    for check in range(2):
+        tests.check_calibration_drift()
+        offsets.append(calibration['current_offset'])
+    if offsets[0] != offsets[1]:
+        raise tests.UnexpectedError(
+            f"Current offset changed from {offsets[0]:.4f} A to {offsets[1]:.4f} A "
+            f"on correcting the same drift again")
+
+def scenario_test(hw):
+    main = importlib.import_module('cynthion-test')
+    yield
+    main.test(False)
+
+def scenario_daemon(hw):
+    daemon = importlib.import_module('daemon')
+    tests.setup()
+    tests.load_calibration()
+    # The simulated probe has no serial device, so give it one that exists.
+    fixture().blackmagic_port = os.devnull
+    yield
+    # Test two units back to back, so that anything the first unit leaves
+    # behind for the next one shows up.
+    for unit in (1, 2):
+        # Each unit is a new EUT, with nothing flashed to it yet.
+        hw.registers.clear()
+        response = daemon.run_unit(False)
+        if response != 'PASS':
+            raise tests.UnexpectedError(f"Unit {unit} gave response {response}")
+
+scenarios = dict(
+    setup = scenario_setup,
+    check_for_shorts = scenario_shorts,
+    test_supply_port = scenario_supply_port,
+    test_supply_port_adaptive = scenario_supply_port_adaptive,
+    test_leds = scenario_leds,
+    test_leds_encoded = scenario_leds_encoded,
+    test_vbus_distribution = scenario_vbus_distribution,
+    calibration_drift = scenario_calibration_drift,
+    test = scenario_test,
+    daemon = scenario_daemon,
+)
+
+def run_scenario(name, hw):
+    hw.levels.clear()
+    hw.registers.clear()
+    modules = [tests]
+    if name in ('test', 'daemon'):
+        modules.append(importlib.import_module('cynthion-test'))
+    if name == 'daemon':
+        modules.append(importlib.import_module('daemon'))
+    with use(Fixture(name)), simulated_fixture(hw, modules), \
+            redirect_stdout(io.StringIO()):
+        steps = scenarios[name](hw)
+        # Run the preparation steps, up to the first yield.
+        next(steps)
+        hw.reset_counters()
+        start = perf_counter()
+        error = None
+        try:
+            with tests.error_conversion():
+                next(steps, None)
+        except tests.CynthionTestError as e:
+            error = f"{e.code}: {e.msg}"
+        elapsed = perf_counter() - start
+        tests.reset()
+        tests.flush()
+    return dict(
+        wall_time=elapsed,
+        round_trips=hw.round_trips,
+        adc_samples=hw.adc_samples,
+        error=error)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print()
+    print(f"{'SCENARIO':<24}{'WALL TIME':>12}{'ROUND TRIPS':>14}{'ADC SAMPLES':>14}{'VS BASELINE':>14}")
+    for name, result in results.items():
+        line = (f"{name:<24}{result['wall_time']:>11.3f}s"
+                f"{result['round_trips']:>14}{result['adc_samples']:>14}")
+        if name in baseline:
+            base = baseline[name]
+            change = result['wall_time'] / base['wall_time'] - 1
+            line += f"{change:>+13.1%}"
+            if change > tolerance:
+                regressions.append(f"{name}: wall time {change:+.1%}")
+            for counter in ('round_trips', 'adc_samples'):
+                if result[counter] > base[counter]:
+                    regressions.append(
+                        f"{name}: {counter} {base[counter]} -> {result[counter]}")
+        print(line)
+        if result['error'] is not None:
+            print(f"  stopped early: {result['error']}")
+            regressions.append(f"{name}: stopped early")
+    print()
+    return regressions
+
+def measure_import_time(module, repeats=3):
+    """ Returns the best time taken to import a module in a new interpreter. """
+    code = ("from time import perf_counter; start = perf_counter(); "
+            f"import importlib; importlib.import_module({module!r}); "
+            "print(perf_counter() - start)")
+    times = []
+    for repeat in range(repeats):
+        process = subprocess.run([sys.executable, '-c', code],
+            stdout=subprocess.PIPE, check=True, text=True)
+        times.append(float(process.stdout.split()[-1]))
+    return min(times)
+
+def check_import_times(budget):
+    overruns = []
+    print(f"{'ENTRY POINT':<24}{'IMPORT TIME':>12}{'BUDGET':>14}")
+    for module in ENTRY_POINTS:
+        elapsed = measure_import_time(module)
+        print(f"{module:<24}{elapsed * 1e3:>10.0f}ms{budget:>12.0f}ms")
+        if elapsed * 1e3 > budget:
+            overruns.append(f"{module}: import took {elapsed * 1e3:.0f}ms, "
+                            f"budget is {budget:.0f}ms")
+    print()
+    return overruns
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the test sequence against a simulated fixture.")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"Scenarios to run: {', '.join(scenarios)} (default: all).")
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help="Latency per hardware round trip, in ms.")
+    parser.add_argument('--sample-time', type=float, default=2.5,
+                        help="Time per ADC sample, in µs.")
+    parser.add_argument('--enumeration-time', type=float, default=100,
+                        help="Time for a USB device to enumerate, in ms.")
+    parser.add_argument('--command-time', type=float, default=200,
+                        help="Time for an external command or FPGA load, in ms.")
+    parser.add_argument('--baseline', default=BASELINE,
+                        help="Baseline file to compare against.")
+    parser.add_argument('--save', action='store_true',
+                        help="Save the results as the new baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Allowed fractional increase in wall time.")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help="Allowed time to import each test entry point, in ms.")
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"unknown scenario '{name}'")
+
+    hw = SimulatedHardware(
+        args.latency / 1e3, args.sample_time / 1e6,
+        args.enumeration_time / 1e3, args.command_time / 1e3)
+
+    results = {name: run_scenario(name, hw)
+        for name in (args.scenarios or scenarios)}
+
+    try:
+        baseline = json.load(open(args.baseline, 'r'))
+    except FileNotFoundError:
+        baseline = {}
+
+    regressions = compare(results, baseline, args.tolerance)
+    regressions += check_import_times(args.import_budget)
+
+    if args.save:
+        baseline.update(results)
+        json.dump(baseline, open(args.baseline, 'w'), indent=4)
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print("Regressions against baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Watcher for the Tycho PASS and FAIL buttons.
+#
+# Each read of a button is a GreatFET request. Rather than polling both
+# buttons as fast as possible while waiting for the operator, a background
+# thread samples them at a modest rate, debounces them, and queues an event
+# for each press. A request waits for the next press, and a FAIL press made
+# while any other step is running aborts the test when the next step starts.
+#
+# The watcher shares the GreatFET with the test sequence, so it serializes
+# all commands sent to the GreatFET with a lock.
+
+from errors import FailButtonError, GF1Error
+import queue
+import threading
+
+# Interval between samples of the buttons, in seconds.
+SAMPLE_INTERVAL = 0.02
+
+# Number of consecutive samples for which a button must hold a new state
+# before the change is accepted.
+DEBOUNCE_SAMPLES = 3
+
+def serialize(gf):
+    # Commands are all sent through the comms backend's execute_raw_command,
+    # so hold the lock around that.
+    comms = gf.comms
+    if getattr(comms, 'lock', None) is not None:
+        return
+    comms.lock = threading.Lock()
+    execute = comms.execute_raw_command
+    def locked(*args, **kwargs):
+        with comms.lock:
+            return execute(*args, **kwargs)
+    comms.execute_raw_command = locked
+
+class ButtonWatcher(threading.Thread):
+    def __init__(self, gf, pass_pin, fail_pin):
+        super().__init__(name="button watcher", daemon=True)
+        self.pins = dict(PASS=pass_pin, FAIL=fail_pin)
+
+        # Presses of each button, by name. None marks that sampling failed.
+        self.events = queue.Queue()
+
+        # Exception raised while sampling, if any.
+        self.error = None
+
+        self.stopping = threading.Event()
+        serialize(gf)
+        self.start()
+
+    def run(self):
+        stable = {}
+        changes = dict.fromkeys(self.pins, 0)
+        while not self.stopping.wait(SAMPLE_INTERVAL):
+            try:
+                # The buttons pull their inputs low when pressed.
+                pressed = {name: not pin.read() for name, pin in self.pins.items()}
+            except Exception as error:
+                self.error = error
+                self.events.put(None)
+                return
+            for name, state in pressed.items():
+                if name not in stable or state == stable[name]:
+                    # A button held down at startup does not count as a press.
+                    stable[name] = state
+                    changes[name] = 0
+                    continue
+                changes[name] += 1
+                if changes[name] == DEBOUNCE_SAMPLES:
+                    stable[name] = state
+                    changes[name] = 0
+                    if state:
+                        self.events.put(name)
+
+    def clear(self):
+        """ Discards any presses made before now. """
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return
+            if event is None:
+                self.events.put(None)
+                return
+
+    def wait(self, timeout=None):
+        """
+        Waits for the next press, returning 'PASS' or 'FAIL', or None if
+        there was no press within the timeout.
+        """
+        try:
+            event = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if event is None:
+            self.events.put(None)
+            raise GF1Error(f"Failed to read buttons from GreatFET: {self.error}")
+        return event
+
+    def check(self):
+        """
+        Raises FailButtonError if FAIL has been pressed since last checked.
+        PASS presses are kept, for a request that is still open.
+        """
+        kept = []
+        try:
+            while True:
+                try:
+                    event = self.events.get_nowait()
+                except queue.Empty:
+                    return
+                if event == 'FAIL':
+                    raise FailButtonError("User pressed the FAIL button")
+                # A failure to sample is left for the test sequence to find
+                # when it next uses the GreatFET.
+                kept.append(event)
+        finally:
+            for event in kept:
+                self.events.put(event)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
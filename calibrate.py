@@ -1,6 +1,43 @@
 from tests import *
+from statistics import linear_regression, mean
 import tests
-import pickle
+import json
+
+# DC-DC converter setpoints used for each divider range. These lie on the
+# converter's 20mV output grid, so the setpoint is an exact reference.
+setpoints = dict(
+    lower = (3.00, 3.60, 4.20, 4.80, 5.40, 6.00),
+    upper = (7.00, 9.00, 11.00, 13.00, 15.00, 17.00, 19.00),
+)
+
+# Expected range of each divider, for selecting it when measuring.
+divider_ranges = dict(
+    lower = Range(0, 6.6),
+    upper = Range(0, 25),
+)
+
+# Channels which can be discharged to a known 0V reference.
+zero_channels = ('VBUS_CON', 'VBUS_AUX', 'VBUS_TA', 'VBUS_TC')
+
+def sweep(divider):
+    references = []
+    readings = []
+    for voltage in setpoints[divider]:
+        set_boost_supply(voltage, 0.1)
+        # Allow the output to settle after each change.
+        sleep(0.05)
+        mux_select('VBUS_TC')
+        _, reading = measure_raw_voltage(divider_ranges[divider])
+        mux_disconnect()
+        item(f"Reading at {info(f'{voltage:.2f} V')}: {info(f'{reading:.4f} V')}")
+        references.append(voltage)
+        readings.append(reading)
+    gain, offset = linear_regression(readings, references)
+    residual = max(abs(gain * reading + offset - reference)
+        for reading, reference in zip(readings, references))
+    item(f"Gain: {info(f'{gain:.5f}')}, offset: {info(f'{offset * 1000:.1f} mV')}, "
+         f"worst residual: {info(f'{residual * 1000:.1f} mV')}")
+    return dict(gain=gain, offset=offset)
 
 def calibrate():
     # Set up test system.
@@ -11,32 +48,87 @@ def calibrate():
     request("disconnect TARGET-C cable from EUT")
     connect_boost_supply_to('TARGET-C')
 
-    # Power TARGET-C at 5V and calibrate lower range.
+    # Sweep the DC-DC converter across each divider range and fit the
+    # readings against the setpoints.
+    ranges = {}
     with group("Calibrating low range"):
-        set_boost_supply(5.0, 0.1)
+        set_boost_supply(setpoints['lower'][0], 0.1)
         # Boost converter needs a moment to stabilise on first startup.
         sleep(0.1)
-        scale_low = 5.0 / test_vbus('TARGET-C', Range(4.9, 5.1))
-        item(f"Calibration factor: {info(scale_low)}")
+        ranges['lower'] = sweep('lower')
 
+    # The current sense voltage is read through the lower range fit, so
+    # measure the offset with the fit in place, so that it also cancels
+    # any error left in the fit.
     with group("Calibrating current offset"):
-        current_offset = test_boost_current(Range(0, 0.15))
-        item(f"Offset: {info(current_offset)}")
+        fixture().calibration['ranges']['lower'] = ranges['lower']
+        currents = []
+        for voltage in setpoints['lower']:
+            set_boost_supply(voltage, 0.1)
+            sleep(0.05)
+            current = measure_boost_current()
+            item(f"Current at {info(f'{voltage:.2f} V')}: {info(f'{current * 1000:.1f} mA')}")
+            currents.append(current)
+        current_offset = test_value(
+            "current offset", 'CDC', mean(currents), 'A', Range(-0.15, 0.15))
 
-    # Increase voltage to 15V and repeat.
     with group("Calibrating high range"):
-        set_boost_supply(15.0, 0.1)
-        scale_high = 15.0 / test_vbus('TARGET-C', Range(14.5, 15.5))
-        item(f"Calibration factor: {info(scale_high)}")
-
-    # Write out calibration.
-    calibration = dict(
-        greatfet_serial=state.gf.serial_number(),
-        voltage_scale_lower=scale_low,
-        voltage_scale_upper=scale_high,
+        ranges['upper'] = sweep('upper')
+
+    fixture().calibration = dict(
+        version=CALIBRATION_VERSION,
+        greatfet_serial=fixture().gf.serial_number(),
+        ranges=ranges,
+        channels={},
         current_offset=current_offset,
     )
-    pickle.dump(calibration, open('calibration.dat', 'wb'))
+
+    # Per-channel offsets, for channels which read above zero when
+    # discharged. Offsets below zero cannot be seen, as the ADC clips.
+    with group("Calibrating channel offsets"):
+        disconnect_supply_and_discharge('TARGET-C')
+        channels = {}
+        for channel in zero_channels:
+            DISCHARGE.high()
+            mux_select(channel)
+            sleep(0.05)
+            divider, reading = measure_raw_voltage(divider_ranges['lower'])
+            mux_disconnect()
+            DISCHARGE.low()
+            voltage = apply_calibration(reading, divider)
+            if voltage > 0:
+                channels[channel] = dict(gain=1.0, offset=-voltage)
+                item(f"Offset on {info(channel)}: {info(f'{-voltage * 1000:.1f} mV')}")
+            else:
+                item(f"Offset on {info(channel)}: {info('none')}")
+        fixture().calibration['channels'] = channels
+
+    # Check the fitted calibration at points between the sweep setpoints.
+    with group("Verifying calibration"):
+        connect_boost_supply_to('TARGET-C')
+        for voltage, expected in (
+                ( 5.00, Range( 4.97,  5.03)),
+                (15.00, Range(14.90, 15.10))):
+            set_boost_supply(voltage, 0.1)
+            sleep(0.05)
+            test_vbus('TARGET-C', expected)
+        disconnect_supply_and_discharge('TARGET-C')
+
+    # Record references for the drift check at the start of each test,
+    # under the same conditions in which setup() leaves the tester.
+    with group("Recording drift check references"):
+        connect_boost_supply_to(None)
+        set_boost_supply(5.0, 0.1)
+        sleep(0.05)
+        with task("Measuring references"):
+            references = measure_references()
+            result(f"{references['D_TEST_PLUS']:.4f} V")
+            result(f"{references['current'] * 1000:.1f} mA")
+        fixture().calibration['references'] = references
+
+    # Write out calibration, keyed by the tester's GreatFET.
+    filename = calibration_filename(fixture().calibration['greatfet_serial'])
+    json.dump(fixture().calibration, open(filename, 'w'), indent=4)
 
 if __name__ == "__main__":
     try:
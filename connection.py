@@ -0,0 +1,99 @@
+# Persistent connection to the EUT's Apollo debugger.
+#
+# apollo_fpga starts and stops a JTAG session around every JTAG operation,
+# including every access to a gateware register, at a cost of several
+# control requests each time. A connection starts one session when it is
+# first needed, and keeps it and a JTAG programmer for as long as the handle
+# stays valid. Operations made meanwhile nest inside the open session.
+#
+# The handle stays valid until something makes Apollo leave the bus: handing
+# the CONTROL port to the FPGA, switching the host's D+/D- away from CONTROL,
+# pressing RESET or PROGRAM, or resetting the fixture. The connection then
+# drops the handle without talking to the device, and reconnects on next use
+# if the MCU owns CONTROL again.
+
+from errors import USBCommsError
+
+MCU = 'MCU'
+FPGA = 'FPGA'
+
+class ApolloConnection:
+    def __init__(self, locate):
+        # Function which finds and opens this fixture's Apollo again.
+        self.locate = locate
+
+        # Open ApolloDebugger, or None if there is no valid handle.
+        self.handle = None
+
+        # Whether a JTAG session is open on the handle.
+        self.session = False
+
+        # JTAG programmer for the open session.
+        self.jtag_programmer = None
+
+        # Which side owns the CONTROL port, or None if not known.
+        self.owner = None
+
+    def open(self, debugger):
+        """ Adopts a newly opened debugger, replacing any previous handle. """
+        self.control_taken_by(MCU)
+        self.handle = debugger
+        return self
+
+    def invalidate(self):
+        """
+        Drops the handle after Apollo has left the bus. No requests are made,
+        since the device they would be sent to is gone.
+        """
+        self.handle = None
+        self.session = False
+        self.jtag_programmer = None
+
+    def control_taken_by(self, owner):
+        """ Records that CONTROL has changed hands, invalidating the handle. """
+        self.invalidate()
+        self.owner = owner
+
+    @property
+    def debugger(self):
+        if self.handle is None:
+            if self.owner == FPGA:
+                raise USBCommsError(
+                    "Apollo is not available while the FPGA owns CONTROL")
+            if self.owner is None:
+                raise USBCommsError(
+                    "Apollo has not been found since the EUT was reset")
+            self.handle = self.locate()
+        return self.handle
+
+    @property
+    def jtag(self):
+        """ The JTAG chain, with a session open on it. """
+        debugger = self.debugger
+        if not self.session:
+            debugger.jtag.__enter__()
+            self.session = True
+        return debugger.jtag
+
+    def programmer(self):
+        if self.jtag_programmer is None:
+            self.jtag_programmer = self.debugger.create_jtag_programmer(self.jtag)
+        return self.jtag_programmer
+
+    def end_session(self):
+        if self.session:
+            self.handle.jtag.__exit__(None, None, None)
+        self.session = False
+        self.jtag_programmer = None
+
+    def handoff_to_fpga(self):
+        self.end_session()
+        self.debugger.allow_fpga_takeover_usb()
+        self.handle.close()
+        self.control_taken_by(FPGA)
+
+    def __getattr__(self, name):
+        # Anything else is passed through to the debugger. Register accesses
+        # are made over JTAG, so open the session for them to use.
+        self.jtag
+        return getattr(self.handle, name)
@@ -1,14 +1,20 @@
 from tests import *
-import ipdb
 import sys
+import tests
+import transactions
 
 def test(user_present: bool):
     # Set up test system.
     setup()
 
-    # Load calibration data.
+    # Load calibration data, and correct it for any drift since calibration.
     load_calibration()
+    check_calibration_drift()
 
+    # Test the EUT.
+    test_eut(user_present)
+
+def test_eut(user_present: bool):
     # First check for shorts at each EUT USB-C port.
     with group("Checking for shorts on all USB-C ports"):
         for port in ('CONTROL', 'AUX', 'TARGET-C'):
@@ -59,22 +65,26 @@ def test(user_present: bool):
 
     # Check all supply rails come up correctly.
     with group("Checking all supply voltages"):
-        for (testpoint, minimum, maximum) in supplies:
-            test_voltage(testpoint, Range(minimum, maximum))
+        test_voltages([(testpoint, Range(minimum, maximum))
+            for (testpoint, minimum, maximum) in supplies])
 
     # Check supply current.
     test_boost_current(Range(0, 0.1))
 
-    # Re-check the CC resistances now that the Type-C controllers have power.
-    with group("Checking CC resistances with EUT powered"):
-        for port in ('AUX', 'TARGET-C'):
-            check_cc_resistances(port)
+    # Start flashing Saturn-V bootloader to MCU via SWD, and carry on with
+    # the checks that don't involve the MCU while it runs.
+    with start_flash_bootloader() as flashing:
+
+        # Re-check the CC resistances now that the Type-C controllers have power.
+        with group("Checking CC resistances with EUT powered"):
+            for port in ('AUX', 'TARGET-C'):
+                check_cc_resistances(port)
 
-    # Check 60MHz clock.
-    test_clock()
+        # Check 60MHz clock.
+        test_clock()
 
-    # Flash Saturn-V bootloader to MCU via SWD.
-    flash_bootloader()
+        # Wait for the bootloader flash to complete.
+        finish_flash_bootloader(flashing)
 
     # Connect host D+/D- to control port.
     connect_host_to('CONTROL')
@@ -107,16 +117,14 @@ def test(user_present: bool):
     # Configure FPGA with test gateware.
     configure_fpga(apollo, 'selftest.bit')
 
-    state.step[0] = 27
+    fixture().step[0] = 27
 
     # Check all PHY supply voltages.
     with group("Checking all PHY supply voltages"):
         # Check +3V3 supply rail as sanity check before checking PHY supplies
-        state.step[1] = -1
-        (testpoint, minimum, maximum) = supplies[0]
-        test_voltage(testpoint, Range(minimum, maximum))
-        for (testpoint, minimum, maximum) in phy_supplies:
-            test_voltage(testpoint, Range(minimum, maximum))
+        fixture().step[1] = -1
+        test_voltages([(testpoint, Range(minimum, maximum))
+            for (testpoint, minimum, maximum) in (supplies[0], *phy_supplies)])
 
     # Run self-test routine. Should include:
     #
@@ -128,7 +136,7 @@ def test(user_present: bool):
     # 
     run_self_test(apollo, user_present)
 
-    state.step[0] = 26
+    fixture().step[0] = 26
 
     # VBUS passthrough from Target-C to Target-A should now be on.
     with group(f"Testing with VBUS applied to {info('TARGET-C')}"):
@@ -142,7 +150,7 @@ def test(user_present: bool):
         # Disconnect TARGET-C supply.
         connect_boost_supply_to('CONTROL')
 
-    state.step[0] = 29
+    fixture().step[0] = 29
 
     # Check that the FPGA can control the supply selection.
     test_supply_selection(apollo)
@@ -152,43 +160,43 @@ def test(user_present: bool):
         for port in ('AUX', 'TARGET-C'):
             test_cc_sbu_control(apollo, port)
 
-    # Run HS speed test.
+    # Run HS speed test, with the PHYs switched over to the speed test
+    # devices in the test gateware.
     with group("Testing USB HS comms on all ports"):
-        configure_fpga(apollo, 'speedtest.bit')
+        select_speed_test(apollo, True)
         request_control_handoff_to_fpga(apollo)
+        speed_test_ports = []
         for port in ('TARGET-C', 'AUX'):
             if port == 'TARGET-C' and not user_present:
                 # TARGET-A cable connected, skip TARGET-C speed test.
                 continue
             connect_boost_supply_to('CONTROL', port)
             test_usb_hs(port)
+            speed_test_ports.append(port)
             connect_host_to(None)
+            if port == 'TARGET-C':
+                # The operator can connect the Target-A cable while the
+                # remaining speed tests run.
+                cable_request = start_request("connect cable to EUT Target-A port")
         connect_boost_supply_to('CONTROL')
         handle = test_usb_hs('CONTROL')
+        speed_test_ports.append('CONTROL')
 
     # Request handoff and reconnect to Apollo.
     with group("Switching to Apollo via handoff"):
         request_control_handoff_to_mcu(handle)
         apollo = test_apollo_present()
 
-    # Flash analyzer bitstream.
-    flash_bitstream(apollo, 'analyzer.bit')
-
-    # Simulate pressing the RESET button, should cause analyzer to enumerate.
-    simulate_reset_button()
-    test_analyzer_present()
-
-    # Trigger handoff by button and reconnect to Apollo.
-    with group("Switching to Apollo via button"):
-        simulate_program_button()
-        apollo = test_apollo_present()
-
-    # Configure FPGA with test gateware again.
-    configure_fpga(apollo, 'selftest.bit')
+    # Check the OUT data that the speed test devices received, which can
+    # only be read once Apollo is back.
+    with group("Checking USB HS data received on all ports"):
+        for port in speed_test_ports:
+            test_usb_hs_received(apollo, port)
+        select_speed_test(apollo, False)
 
     if user_present:
-        # Request the operator connect a cable to Target-A.
-        request("connect cable to EUT Target-A port")
+        # Wait for the operator to connect a cable to Target-A.
+        finish_request(cable_request)
 
         # Check that the Target-A cable is connected.
         with group("Checking Target-A cable is connected"):
@@ -250,19 +258,27 @@ def test(user_present: bool):
     if user_present:
         test_user_button(apollo)
 
-    # Request press of RESET button, should cause analyzer to enumerate.
-    if user_present:
-        request('press the RESET button')
-    else:
-        simulate_reset_button()
+    # Flash analyzer bitstream. This replaces the test gateware, so is done
+    # once all the tests using it are complete.
+    flash_bitstream(apollo, 'analyzer.bit')
+
+    # Simulate pressing the RESET button, should cause analyzer to enumerate.
+    simulate_reset_button()
     test_analyzer_present()
 
-    # Request press of PROGRAM button, should cause Apollo to enumerate.
+    # Simulate pressing the PROGRAM button, should cause Apollo to enumerate.
+    with group("Switching to Apollo via button"):
+        simulate_program_button()
+        test_apollo_present()
+
     if user_present:
+        # Request press of RESET button, should cause analyzer to enumerate.
+        request('press the RESET button')
+        test_analyzer_present()
+
+        # Request press of PROGRAM button, should cause Apollo to enumerate.
         request('press the PROGRAM button')
-    else:
-        simulate_program_button()
-    test_apollo_present()
+        test_apollo_present()
 
     # Power down the EUT.
     with group("Powering off EUT"):
@@ -270,19 +286,25 @@ def test(user_present: bool):
         connect_host_supply_to(None)
 
 if __name__ == "__main__":
+    if unknown := [arg for arg in sys.argv[1:] if arg not in ('unattended', 'debug', *test_modes)]:
+        sys.exit(f"Unknown arguments: {' '.join(unknown)}. "
+                 f"Options are unattended, debug, and the test modes: {', '.join(test_modes)}.")
     user_present = 'unattended' not in sys.argv[1:]
+    fixture().modes = {arg for arg in sys.argv[1:] if arg in test_modes}
     if user_present:
         enable_numbering(True)
-    try:
-        with error_conversion():
-            test(user_present)
-            ok("All tests completed")
-            retcode = 0
-    except CynthionTestError as error:
-        retcode = 1
-        fail(error)
-        if 'debug' in sys.argv[1:]:
-            ipdb.post_mortem()
-    enable_numbering(False)
-    reset()
+    with transactions.from_environment([tests, sys.modules[__name__]]):
+        try:
+            with error_conversion():
+                test(user_present)
+                ok("All tests completed")
+                retcode = 0
+        except CynthionTestError as error:
+            retcode = 1
+            fail(error)
+            if 'debug' in sys.argv[1:]:
+                import ipdb
+                ipdb.post_mortem()
+        enable_numbering(False)
+        reset()
     sys.exit(retcode)
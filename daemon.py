@@ -0,0 +1,154 @@
+# Long-running fixture daemon.
+#
+# Sets up the test system once, then tests one EUT per request. Requests
+# are read a line at a time from a Unix socket, or from a pair of named
+# pipes, and each is answered with a single line:
+#
+#   test [unattended] [<mode>...]  ->  PASS, or FAIL <code>
+#   status             ->  READY
+#   quit               ->  OK
+#
+# Between EUTs, only what could have changed is re-checked: that the
+# GreatFET still responds, the 24V supply and DC-DC converter, the BMP
+# serial port, and calibration drift. If the GreatFET is lost, the next
+# request runs the full setup again.
+
+from tests import *
+import argparse
+import importlib
+import os
+import socket
+import sys
+
+main = importlib.import_module('cynthion-test')
+
+SOCKET = '/tmp/cynthion-test.sock'
+
+class SocketChannel:
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+    def requests(self):
+        while True:
+            connection, _ = self.server.accept()
+            with connection, connection.makefile('rw') as stream:
+                for line in stream:
+                    self.stream = stream
+                    yield line.strip()
+
+    def respond(self, text):
+        self.stream.write(text + '\n')
+        self.stream.flush()
+
+class PipeChannel:
+    def __init__(self, request_path, response_path):
+        self.request_path = request_path
+        self.response_path = response_path
+
+    def requests(self):
+        while True:
+            # Opening blocks until a writer connects; reopen when it leaves.
+            with open(self.request_path, 'r') as pipe:
+                for line in pipe:
+                    yield line.strip()
+
+    def respond(self, text):
+        with open(self.response_path, 'w') as pipe:
+            pipe.write(text + '\n')
+
+def begin_unit():
+    fixture().mcu_serial = None
+    fixture().flash_serial = None
+    fixture().boost_port = None
+    fixture().indent = 0
+    fixture().step = [0]
+    # Button presses made between units do not apply to this one.
+    if fixture().buttons is not None:
+        fixture().buttons.clear()
+
+def run_unit(user_present, modes=()):
+    begin_unit()
+    fixture().modes = set(modes)
+    log_header(['cynthion-test.py'] + ([] if user_present else ['unattended']) + sorted(modes))
+    enable_numbering(user_present)
+    try:
+        with error_conversion():
+            if fixture().gf is None:
+                setup()
+                load_calibration()
+            else:
+                reverify()
+            check_calibration_drift()
+            main.test_eut(user_present)
+            ok("All tests completed")
+            response = 'PASS'
+    except CynthionTestError as error:
+        fail(error)
+        response = f'FAIL {error.code}'
+    enable_numbering(False)
+    reset()
+    flush()
+    return response
+
+def serve(channel):
+    with group("Starting fixture daemon"):
+        setup()
+        load_calibration()
+    flush()
+    for request in channel.requests():
+        command, *args = request.split() or ['']
+        if command == 'test':
+            if unknown := [arg for arg in args if arg not in ('unattended', *test_modes)]:
+                channel.respond(f'ERROR unknown arguments: {" ".join(unknown)}')
+            else:
+                channel.respond(run_unit('unattended' not in args,
+                    [arg for arg in args if arg in test_modes]))
+        elif command == 'status':
+            channel.respond('READY')
+        elif command == 'quit':
+            channel.respond('OK')
+            break
+        else:
+            channel.respond(f'ERROR unknown command: {request}')
+
+def send(path, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    with client, client.makefile('rw') as stream:
+        stream.write(request + '\n')
+        stream.flush()
+        return stream.readline().strip()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cynthion fixture daemon.")
+    parser.add_argument('--socket', default=SOCKET,
+                        help="Unix socket to listen on.")
+    parser.add_argument('--pipes', nargs=2, metavar=('REQUEST', 'RESPONSE'),
+                        help="Named pipes to use instead of a socket.")
+    parser.add_argument('--send', nargs='+', metavar='REQUEST',
+                        help="Send a request to a running daemon and exit.")
+    args = parser.parse_args()
+
+    if args.send:
+        response = send(args.socket, ' '.join(args.send))
+        print(response)
+        sys.exit(0 if response in ('PASS', 'READY', 'OK') else 1)
+
+    if args.pipes:
+        channel = PipeChannel(*args.pipes)
+    else:
+        channel = SocketChannel(args.socket)
+
+    try:
+        with error_conversion():
+            serve(channel)
+        retcode = 0
+    except CynthionTestError as error:
+        fail(error)
+        retcode = 1
+    reset()
+    sys.exit(retcode)
@@ -0,0 +1,105 @@
+# Asynchronous execution of test operations.
+#
+# Test steps are written as ordinary blocking code, but operations that
+# spend most of their time waiting can be started on the engine instead,
+# and their results collected later. Meanwhile the test carries on with
+# other work, e.g. analog checks can run while gdb is flashing the MCU.
+#
+# The engine runs one asyncio event loop per process, in a background
+# thread, shared by all the fixtures driven from that process. Blocking
+# calls to a device are run on a worker thread for that device of that
+# fixture, so that calls to one device are never made concurrently.
+
+from concurrent.futures import ThreadPoolExecutor
+from fixture import fixture, use
+import asyncio
+import contextvars
+import subprocess
+import threading
+
+loop = None
+loop_lock = threading.Lock()
+
+executors = {}
+executors_lock = threading.Lock()
+
+def get_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="engine", daemon=True).start()
+    return loop
+
+class Pending:
+    """
+    An operation running on the engine. Used as a context manager, the
+    operation is cancelled if the block is left before it has completed,
+    e.g. because a test step failed.
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        self.future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not self.future.done():
+            self.future.cancel()
+        return False
+
+def submit(coroutine):
+    """ Starts a coroutine on the engine, for the current fixture. """
+    selected = fixture()
+    async def bound():
+        with use(selected):
+            return await coroutine
+    return Pending(asyncio.run_coroutine_threadsafe(bound(), get_loop()))
+
+def run(coroutine):
+    """ Runs a coroutine on the engine, and waits for its result. """
+    return submit(coroutine).result()
+
+def executor(device):
+    with executors_lock:
+        key = (fixture(), device)
+        if key not in executors:
+            executors[key] = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=device)
+        return executors[key]
+
+async def call(device, function, *args):
+    """ Calls a blocking function on the worker thread for a device. """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor(device), context.run, function, *args)
+
+async def greatfet(function, *args):
+    return await call('greatfet', function, *args)
+
+async def apollo(function, *args):
+    return await call('apollo', function, *args)
+
+async def command(cmd):
+    """ Runs a command, returning a CompletedProcess as subprocess.run does. """
+    args = cmd.split(" ")
+    process = await asyncio.create_subprocess_exec(*args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    try:
+        stdout, _ = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    return subprocess.CompletedProcess(args, process.returncode, stdout)
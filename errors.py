@@ -1,6 +1,6 @@
-import state
-import usb1
-import usb
+from time import time
+from fixture import fixture
+import sys
 
 """
 Base class for all exceptions which may be generated by the test.
@@ -8,7 +8,10 @@ Base class for all exceptions which may be generated by the test.
 class CynthionTestError(Exception):
     def __init__(self, msg):
         self.msg = msg
-        self.step = ".".join(str(s) for s in state.step)
+        self.step = ".".join(str(s) for s in fixture().step)
+        # Time window of the step in which the error occured.
+        self.time = time()
+        self.start = fixture().step_start or self.time
 
 # Define subclasses with associated three-letter codes.
 for code, name in (
@@ -35,6 +38,7 @@ for code, name in (
     ('CBL', 'CableError'),       # A cable was not in the correct position.
     ('USB', 'USBCommsError'),    # Problem with USB communications to the EUT.
     ('FX2', 'FX2Error'),         # Problem with USB through the EUT to the FX2.
+    ('RPL', 'ReplayError'),      # Replayed run diverged from its recorded trace.
 ):
     globals()[name] = type(name, (CynthionTestError,), {'code': code})
 
@@ -47,20 +51,25 @@ FX2Error.device = "Tycho FX2"
 # Override __init__ method in GF1Error to mark the GF1 no longer usable.
 def __init__(self, msg):
     CynthionTestError.__init__(self, msg)
-    state.gf = None
+    fixture().gf = None
 GF1Error.__init__ = __init__
 
 """
 Takes an exception and if it is not a CynthionTestError, raises a
 suitable CynthionTestError wrapper.
 """
+def usb_exceptions():
+    # Only USB libraries that have been imported can have raised an error.
+    return tuple(module.USBError
+        for module in (sys.modules.get('usb'), sys.modules.get('usb1'))
+        if module is not None)
+
 def wrap_exception(exc, usb_err_type=USBCommsError):
-    usb_exceptions = (usb.USBError, usb1.USBError)
     if isinstance(exc, CynthionTestError):
         return
     elif isinstance(exc, KeyboardInterrupt):
         raise TestStoppedError("Test stopped by keyboard interrupt.")
-    elif isinstance(exc, usb_exceptions):
+    elif isinstance(exc, usb_exceptions()):
         if hasattr(exc, 'strerror'):
             raise usb_err_type(
                 f"{usb_err_type.device} USB error: {exc.strerror}")
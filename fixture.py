@@ -0,0 +1,110 @@
+# Per-fixture test state.
+#
+# A Fixture owns the hardware handles, pins, calibration, logging state and
+# USB matching state for one Tycho. The fixture being driven is held in a
+# context variable, so that one process can drive several fixtures, each
+# from its own thread, with each thread seeing only its own fixture.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+
+class Fixture:
+    def __init__(self, name=None, writer=None,
+                 greatfet_serial=None, blackmagic_serial=None, usb_path=None):
+        # Name of this fixture, for identifying it in logs.
+        self.name = name
+
+        # Log writer for this fixture's output, or None to use the default.
+        self.writer = writer
+
+        # Serial numbers of this fixture's GreatFET and Black Magic Probe,
+        # or None to use whichever is found.
+        self.greatfet_serial = greatfet_serial
+        self.blackmagic_serial = blackmagic_serial
+
+        # USB path of the hub this fixture's devices are attached through,
+        # e.g. "1-2.3", or None to accept devices anywhere.
+        self.usb_path = usb_path
+
+        # Optional test modes selected for this run, see tests.test_modes.
+        self.modes = set()
+
+        # Bus and address of the last new USB device detected.
+        self.last_bus = None
+        self.last_addr = None
+
+        # Current indent level for formatting.
+        self.indent = 0
+
+        # Whether test step numbering is currently enabled.
+        self.numbering = False
+        # Curent step numbering.
+        self.step = [0]
+        # Time at which the current step started.
+        self.step_start = None
+
+        # GreatFET instance.
+        self.gf = None
+
+        # GreatFET GPIO pins, by name.
+        self.pins = {}
+
+        # GreatFET GPIO lines, by pin name, for setting several pins at once.
+        self.lines = {}
+
+        # Watcher for the PASS and FAIL buttons, see buttons.py.
+        self.buttons = None
+
+        # DC-DC converter instance.
+        self.boost = None
+
+        # Connection to the EUT's Apollo debugger, see connection.py.
+        self.apollo = None
+
+        # Serial port device to use for Black Magic Probe.
+        self.blackmagic_port = None
+
+        # MCU serial number of the current EUT.
+        self.mcu_serial = None
+
+        # SPI Flash serial number of the current EUT.
+        self.flash_serial = None
+
+        # EUT port that the boost converter is currently supplying.
+        self.boost_port = None
+
+        # Calibration data.
+        self.calibration = dict(
+            version = 2,
+            greatfet_serial = None,
+            ranges = dict(
+                lower = dict(gain = 1.0, offset = 0.0),
+                upper = dict(gain = 1.0, offset = 0.0),
+            ),
+            channels = {},
+            current_offset = 0.0,
+        )
+
+# Fixture used when none has been selected, e.g. by the single-fixture
+# entry points. When run as one of several stations, the station's devices
+# are selected by environment variables, see orchestrate.py.
+default = Fixture(
+    name=os.environ.get('CYNTHION_TEST_STATION'),
+    greatfet_serial=os.environ.get('CYNTHION_TEST_GREATFET'),
+    blackmagic_serial=os.environ.get('CYNTHION_TEST_BLACKMAGIC'),
+    usb_path=os.environ.get('CYNTHION_TEST_USB_PATH'),
+)
+
+current = ContextVar('fixture')
+
+def fixture():
+    return current.get(default)
+
+@contextmanager
+def use(selected):
+    token = current.set(selected)
+    try:
+        yield selected
+    finally:
+        current.reset(token)
@@ -1,42 +1,138 @@
 from colorama import Fore, Back, Style
 from errors import wrap_exception, USBCommsError
-from time import strftime
+from time import strftime, localtime, time
 import colorama
-import state
+import kernel_log
+from fixture import fixture
+import atexit
 import os
+import queue
 import re
 import sys
+import threading
 
-colorama.init()
+ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 
-if filename := os.environ.get('CYNTHION_TEST_LOG'):
-    logfile = open(filename, 'a')
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-    print(strftime("%Y-%m-%d %H:%M:%S ") + ' '.join(sys.argv), file=logfile)
-else:
-    logfile = None
+class LogWriter(threading.Thread):
+    """
+    Background thread which writes log output to the console and log file.
 
-def log(*args, **kwargs):
-    kwargs['flush'] = True
-    print(*args, **kwargs)
-    if logfile is not None:
-        print(*(strip(arg) for arg in args), file=logfile, **kwargs)
+    Output is queued by the test thread and written out in batches, so that
+    slow terminals or log files do not delay timing-sensitive test steps.
+
+    If writing to the console or log file fails, the error is reported on
+    stderr and that output is dropped from then on, while the queue keeps
+    being drained, so that the test is never held up by its log output.
+    """
+    def __init__(self, logfile, maxsize=4096):
+        super().__init__(name="log writer", daemon=True)
+        self.logfile = logfile
+        self.console = True
+        self.queue = queue.Queue(maxsize)
+        self.start()
+
+    def write(self, text, console=True):
+        # Wait for space in the queue, but not for a writer that has stopped.
+        while self.is_alive():
+            try:
+                self.queue.put((text, console), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def flush(self):
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.is_alive():
+                self.queue.all_tasks_done.wait(0.1)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.console:
+                    try:
+                        sys.stdout.write(''.join(text for text, console in batch if console))
+                        sys.stdout.flush()
+                    except Exception as error:
+                        self.console = False
+                        self.report("console", error)
+                if self.logfile is not None:
+                    try:
+                        self.logfile.write(strip(''.join(text for text, _ in batch)))
+                        self.logfile.flush()
+                    except Exception as error:
+                        self.logfile = None
+                        self.report("log file", error)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def report(self, output, error):
+        try:
+            sys.stderr.write(f"Failed to write to {output}, output dropped: {error!r}\n")
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+# The default log writer, and its log file, are only set up when first used.
+writer = None
+writer_lock = threading.Lock()
+
+def default_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            colorama.init()
+            if filename := os.environ.get('CYNTHION_TEST_LOG'):
+                logfile = open(filename, 'a')
+            else:
+                logfile = None
+            writer = LogWriter(logfile)
+            # Make sure all queued output is written out before the process exits.
+            atexit.register(writer.flush)
+            log_header(sys.argv, writer)
+    return writer
+
+def sink():
+    # Fixtures with their own log writer use it, others share the default.
+    return fixture().writer or default_writer()
+
+def log(*args, sep=' ', end='\n'):
+    sink().write(sep.join(str(arg) for arg in args) + end)
+
+def flush():
+    sink().flush()
+
+def log_header(argv, writer=None):
+    # Marks the start of a test run in the log file, for log_parser.py.
+    (writer or sink()).write(strftime("%Y-%m-%d %H:%M:%S ") + ' '.join(argv) + '\n', console=False)
 
 def strip(text):
     return ansi_escape.sub('', text)
 
 def enable_numbering(enable):
-    state.numbering = enable
+    fixture().numbering = enable
+
+def check_buttons():
+    # Abort before starting a step if the operator has pressed FAIL.
+    if fixture().buttons is not None:
+        fixture().buttons.check()
 
 def msg(text, end):
-    if state.numbering:
-        state.step[-1] += 1
-        step_text = ".".join(str(s) for s in state.step)
+    fixture().step_start = time()
+    if fixture().numbering:
+        fixture().step[-1] += 1
+        step_text = ".".join(str(s) for s in fixture().step)
         step_text += " " * (11 - len(step_text))
         prefix = Fore.YELLOW + step_text + Style.RESET_ALL + "│ "
     else:
         prefix = ""
-    log(prefix + ("  " * state.indent ) + "• " + text + Style.RESET_ALL, end=end)
+    log(prefix + ("  " * fixture().indent ) + "• " + text + Style.RESET_ALL, end=end)
 
 def item(text):
     msg(text, "\n")
@@ -59,6 +155,7 @@ def ask(text):
         Fore.RED + "FAIL" + Fore.CYAN + " === " +
         Style.RESET_ALL)
     log()
+    flush()
 
 def ok(text):
     log()
@@ -66,7 +163,7 @@ def ok(text):
     log()
 
 def fail(err):
-    if state.numbering:
+    if fixture().numbering:
         step_text = err.step + '-'
     else:
         step_text = ''
@@ -76,40 +173,48 @@ def fail(err):
     log(err.msg)
     log()
     if isinstance(err, USBCommsError):
-        logfile = '/var/log/kern.log'
-        prefix = 'kernel: '
-        count = 10
         try:
-            log_lines = open(logfile, 'r').readlines()
-            log(f"Last {count} lines of {logfile}:\n")
-            for line in log_lines[-count:]:
-                start = line.find(prefix) + len(prefix)
-                log(line.rstrip()[start:])
-        except IOError as e:
-            log(f"Failed to read {logfile}: {e.strerror}")
+            source, messages = kernel_log.capture(err.start, err.time)
+            if messages:
+                log(f"Kernel messages from {source} during failing step:\n")
+                for stamp, message in messages:
+                    log(strftime("%H:%M:%S ", localtime(stamp)) + message)
+            else:
+                count = 10
+                log(f"No kernel messages during failing step. " +
+                    f"Last {count} lines of {kernel_log.KERN_LOG}:\n")
+                prefix = 'kernel: '
+                for line in kernel_log.tail(kernel_log.KERN_LOG, count):
+                    start = line.find(prefix) + len(prefix)
+                    log(line.rstrip()[start:])
+        except OSError as e:
+            log(f"Failed to read kernel log: {e.strerror or e}")
         log()
+    flush()
 
 class group():
     def __init__(self, text):
         self.text = text
     def __enter__(self):
+        check_buttons()
         msg(self.text, ":\n")
-        state.indent += 1
-        state.step.append(0)
+        fixture().indent += 1
+        fixture().step.append(0)
         return self
     def __exit__(self, exc_type, exc_value, exc_tb):
         # If we got an exception, wrap it into a CynthionTestError now,
         # before we lose the step information.
         if exc_value is not None:
             wrap_exception(exc_value)
-        state.step.pop()
-        state.indent -= 1
+        fixture().step.pop()
+        fixture().indent -= 1
         return False
 
 class task():
     def __init__(self, text):
         self.text = text
     def __enter__(self):
+        check_buttons()
         msg(self.text, "... ")
         return self
     def __exit__(self, exc_type, exc_value, exc_tb):
@@ -0,0 +1,110 @@
+# Capture of kernel log messages, for reporting alongside USB errors.
+
+from datetime import datetime
+from time import time, clock_gettime, CLOCK_MONOTONIC
+import os
+
+KERN_LOG = '/var/log/kern.log'
+KMSG = '/dev/kmsg'
+
+def reverse_lines(path, block_size=4096):
+    """
+    Yields the lines of a file in reverse order, by reading backwards in
+    blocks from the end. Only as much of the file as is consumed is read.
+    """
+    with open(path, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        remainder = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            file.seek(position)
+            lines = (file.read(size) + remainder).split(b'\n')
+            # The first line may be incomplete, keep it for the next block.
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode(errors='replace')
+        if remainder:
+            yield remainder.decode(errors='replace')
+
+def tail(path, count):
+    """ Returns the last lines of a file, without reading the whole file. """
+    lines = []
+    for line in reverse_lines(path):
+        if len(lines) == count:
+            break
+        lines.append(line)
+    return lines[::-1]
+
+def parse_syslog_line(line, prefix='kernel: '):
+    """ Returns the timestamp and message of a syslog line, or None. """
+    start = line.find(prefix)
+    if start < 0:
+        return None
+    message = line[start + len(prefix):]
+    try:
+        # RFC 3339 timestamps, e.g. "2024-05-01T10:11:12.123456-06:00 host".
+        stamp = datetime.fromisoformat(line.split(' ', 1)[0]).timestamp()
+    except ValueError:
+        try:
+            # Traditional timestamps, e.g. "May  1 10:11:12 host".
+            stamp = datetime.strptime(
+                f"{datetime.now().year} {line[:15]}",
+                "%Y %b %d %H:%M:%S").timestamp()
+        except ValueError:
+            return None
+    return stamp, message
+
+def read_kern_log(start, end, path=KERN_LOG):
+    """
+    Returns kernel messages logged between the start and end times, by
+    reading the log file backwards until the start time is passed.
+    """
+    messages = []
+    for line in reverse_lines(path):
+        if (parsed := parse_syslog_line(line)) is None:
+            continue
+        stamp, message = parsed
+        # Syslog timestamps have a resolution of one second.
+        if stamp < int(start):
+            break
+        if stamp <= end:
+            messages.append((stamp, message))
+    return messages[::-1]
+
+def read_kmsg(start, end, path=KMSG):
+    """ Returns kernel messages logged between the start and end times. """
+    # Timestamps in the kernel buffer are relative to the monotonic clock.
+    offset = time() - clock_gettime(CLOCK_MONOTONIC)
+    messages = []
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while True:
+            try:
+                record = os.read(fd, 8192).decode(errors='replace')
+            except BlockingIOError:
+                break
+            except BrokenPipeError:
+                # Record was overwritten while reading, skip it.
+                continue
+            header, _, message = record.partition(';')
+            stamp = offset + int(header.split(',')[2]) / 1e6
+            if start <= stamp <= end:
+                messages.append((stamp, message.split('\n')[0]))
+    finally:
+        os.close(fd)
+    return messages
+
+def capture(start, end, margin=1.0):
+    """
+    Returns the source and messages from the kernel log during a time window,
+    widened by a margin to allow for messages logged slightly early or late.
+    Reads from /dev/kmsg where permitted, and falls back to kern.log.
+    """
+    for source, reader in ((KMSG, read_kmsg), (KERN_LOG, read_kern_log)):
+        try:
+            return source, reader(start - margin, end + margin)
+        except OSError:
+            continue
+    raise OSError(f"Could not read {KMSG} or {KERN_LOG}")
@@ -0,0 +1,171 @@
+# Multi-fixture orchestration.
+#
+# Discovers every Tycho attached to this host, and tests the EUTs in all of
+# them in parallel, each in its own worker process running cynthion-test.py.
+#
+# A station is a GreatFET and Black Magic Probe attached through the same
+# hub. Each worker is bound to its station's devices, calibration and log
+# file through environment variables:
+#
+#   CYNTHION_TEST_STATION     Station name.
+#   CYNTHION_TEST_GREATFET    GreatFET serial number.
+#   CYNTHION_TEST_BLACKMAGIC  Black Magic Probe serial number.
+#   CYNTHION_TEST_USB_PATH    USB path of the station's hub, e.g. "1-2.3".
+#   CYNTHION_TEST_LOG         Log file for the station.
+#
+# Stations on the same USB bus share its bandwidth, so their HS speed tests
+# take turns rather than running concurrently.
+
+from colorama import Fore, Style
+from formatting import strip
+from threading import Thread
+from time import sleep
+import argparse
+import colorama
+import os
+import subprocess
+import sys
+import usb1
+
+GREATFET = (0x1d50, 0x60e6)
+BLACKMAGIC = (0x1d50, 0x6018)
+
+def discover(context):
+    # Group GreatFETs and Black Magic Probes by the hub they are attached to.
+    hubs = {}
+    for device in context.getDeviceIterator(skip_on_error=True):
+        ids = (device.getVendorID(), device.getProductID())
+        if ids not in (GREATFET, BLACKMAGIC):
+            continue
+        ports = device.getPortNumberList()
+        hub = f"{device.getBusNumber()}-" + '.'.join(str(port) for port in ports[:-1])
+        try:
+            serial = device.getSerialNumber()
+        except usb1.USBError:
+            serial = None
+        kind = 'greatfet' if ids == GREATFET else 'blackmagic'
+        hubs.setdefault(hub, {}).setdefault(kind, []).append(serial)
+    stations = []
+    problems = []
+    for hub, devices in sorted(hubs.items()):
+        greatfets = devices.get('greatfet', [])
+        blackmagics = devices.get('blackmagic', [])
+        if len(greatfets) != 1 or len(blackmagics) != 1 or None in greatfets + blackmagics:
+            problems.append(
+                f"Hub {hub} has {len(greatfets)} GreatFET(s) and "
+                f"{len(blackmagics)} Black Magic Probe(s), skipping")
+            continue
+        stations.append(dict(
+            name=f"tycho-{len(stations) + 1}",
+            greatfet=greatfets[0],
+            blackmagic=blackmagics[0],
+            usb_path=hub,
+            bus=int(hub.split('-')[0])))
+    return stations, problems
+
+def placement(stations):
+    buses = {}
+    for station in stations:
+        buses.setdefault(station['bus'], []).append(station['name'])
+    for bus, names in sorted(buses.items()):
+        note = ""
+        if len(names) > 1:
+            note = (Fore.YELLOW + " (HS speed tests will take turns; "
+                    "use separate host controllers for full throughput)" +
+                    Style.RESET_ALL)
+        print(f"USB bus {bus}: {', '.join(names)}{note}")
+
+class Worker(Thread):
+    def __init__(self, station, log_dir, args):
+        super().__init__(name=station['name'], daemon=True)
+        self.station = station
+        self.step = "Starting"
+        self.result = None
+        self.log = os.path.join(log_dir, f"{station['name']}.log")
+        env = dict(os.environ,
+            CYNTHION_TEST_STATION=station['name'],
+            CYNTHION_TEST_GREATFET=station['greatfet'],
+            CYNTHION_TEST_BLACKMAGIC=station['blackmagic'],
+            CYNTHION_TEST_USB_PATH=station['usb_path'],
+            CYNTHION_TEST_LOG=self.log)
+        self.process = subprocess.Popen(
+            [sys.executable, 'cynthion-test.py', *args],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True)
+        self.start()
+
+    def run(self):
+        for line in self.process.stdout:
+            line = strip(line).rstrip()
+            # Drop any step number prefix.
+            line = line.split("│ ", 1)[-1]
+            if line.startswith("• "):
+                # Top level step.
+                self.step = line[2:].rstrip(':.')
+            elif line.startswith("FAIL "):
+                self.result = line
+            elif line.startswith("PASS"):
+                self.result = "PASS"
+        if self.process.wait() != 0 and self.result is None:
+            self.result = f"FAIL (exit code {self.process.returncode})"
+
+    def status(self):
+        if self.result is None:
+            return Fore.CYAN + "RUNNING" + Style.RESET_ALL + f"  {self.step}"
+        colour = Fore.GREEN if self.result == "PASS" else Fore.RED
+        return colour + self.result + Style.RESET_ALL + f"  {self.step}"
+
+def show(workers, redraw):
+    if redraw:
+        # Move back up over the previous status view.
+        print(f"\x1B[{len(workers)}A", end='')
+    for worker in workers:
+        print(f"\x1B[2K{worker.name:<10} {worker.status()}")
+    sys.stdout.flush()
+
+def run(stations, log_dir, args):
+    os.makedirs(log_dir, exist_ok=True)
+    workers = [Worker(station, log_dir, args) for station in stations]
+    print()
+    show(workers, False)
+    while any(worker.is_alive() for worker in workers):
+        sleep(0.5)
+        show(workers, True)
+    show(workers, True)
+    print()
+    for worker in workers:
+        print(f"{worker.name}: log written to {worker.log}")
+    return all(worker.result == "PASS" for worker in workers)
+
+if __name__ == "__main__":
+    colorama.init()
+    parser = argparse.ArgumentParser(
+        description="Test EUTs in all attached Tycho fixtures in parallel.")
+    parser.add_argument('--list', action='store_true',
+        help="list the stations found, without testing")
+    parser.add_argument('--log-dir', default='logs',
+        help="directory for per-station log files")
+    parser.add_argument('--attended', action='store_true',
+        help="run with operator interaction, rather than unattended")
+    args = parser.parse_args()
+
+    with usb1.USBContext() as context:
+        stations, problems = discover(context)
+    for problem in problems:
+        print(Fore.YELLOW + problem + Style.RESET_ALL)
+    if not stations:
+        print(Fore.RED + "No stations found. Check USB connections." + Style.RESET_ALL)
+        sys.exit(1)
+    for station in stations:
+        print(f"{station['name']}: hub {station['usb_path']}, "
+              f"GreatFET {station['greatfet']}, "
+              f"Black Magic Probe {station['blackmagic']}")
+    placement(stations)
+    if args.list:
+        sys.exit(0)
+
+    passed = run(stations, args.log_dir, [] if args.attended else ['unattended'])
+    sys.exit(0 if passed else 1)
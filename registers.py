@@ -0,0 +1,83 @@
+# Register addresses and parameters of the self-test gateware, shared by the
+# gateware and the host.
+#
+# The base registers are those of the Cynthion self-test gateware. They are
+# loaded from its source file directly, because importing the cynthion
+# package would also import all of its gateware.
+
+import importlib.util
+import os
+
+def load_base_registers():
+    package = importlib.util.find_spec('cynthion')
+    path = os.path.join(
+        package.submodule_search_locations[0], 'selftest', 'registers.py')
+    spec = importlib.util.spec_from_file_location('cynthion_registers', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return {name: value for name, value in vars(module).items()
+        if name.startswith('REGISTER_')}
+
+globals().update(load_base_registers())
+
+REGISTER_TARGET_TYPEC_CTL_ADDR  = 22
+REGISTER_TARGET_TYPEC_CTL_VALUE = 23
+REGISTER_AUX_TYPEC_CTL_ADDR     = 24
+REGISTER_AUX_TYPEC_CTL_VALUE    = 25
+REGISTER_PWR_MON_ADDR           = 26
+REGISTER_PWR_MON_VALUE          = 27
+
+REGISTER_CON_VBUS_EN            = 28
+REGISTER_AUX_VBUS_EN            = 29
+REGISTER_PASS_CONTROL           = 30
+REGISTER_PASS_AUX               = 31
+REGISTER_PASS_TARGET_C          = 32
+
+REGISTER_AUX_SBU                = 33
+REGISTER_TARGET_SBU             = 34
+
+REGISTER_BUTTON_USER            = 35
+
+REGISTER_PMOD_A_OUT             = 36
+REGISTER_PMOD_B_IN              = 37
+
+REGISTER_SENSE_DP               = 38
+REGISTER_SENSE_DM               = 39
+
+REGISTER_SPEED_TEST             = 40
+
+REGISTER_PWR_MON_POLL           = 41
+REGISTER_PWR_MON_SAMPLES        = 42  # Reading latches the readings below.
+REGISTER_PWR_MON_READINGS       = 43  # Through 50: PAC195x registers 0x07-0x0E.
+
+REGISTER_PMOD_BIST              = 51  # Bits 0-7 mismatches, 8 done, 9 passed.
+
+REGISTER_RAM_BIST               = 52  # Bit 0 done, 1 passed.
+REGISTER_RAM_BIST_ERRORS        = 53
+REGISTER_RAM_BIST_FIRST_ERROR   = 54
+REGISTER_RAM_BIST_WRITE_CYCLES  = 55
+REGISTER_RAM_BIST_READ_CYCLES   = 56
+
+REGISTER_CONTROL_SPEED_ERRORS   = 57
+REGISTER_AUX_SPEED_ERRORS       = 58
+REGISTER_TARGET_SPEED_ERRORS    = 59
+REGISTER_CONTROL_SPEED_CHECKED  = 60
+REGISTER_AUX_SPEED_CHECKED      = 61
+REGISTER_TARGET_SPEED_CHECKED   = 62
+
+REGISTER_DPDM_SENSE             = 63  # Bits 0-5 D+/D- per configuration, 6 done.
+
+# Clock frequencies of the self-test gateware's domains, in MHz. The gateware
+# is built with these in place of the base design's own, so that the host
+# can use them without importing the gateware.
+SELFTEST_CLOCK_FREQUENCIES = {
+    "fast": 60,
+    "sync": 60,
+    "usb":  60,
+}
+
+# Frequency of the sync domain, in which the gateware counts cycles, in Hz.
+SELFTEST_CLOCK_HZ = SELFTEST_CLOCK_FREQUENCIES["sync"] * 1e6
+
+# HyperRAM size in 16-bit words, as tested by the HyperRAM self-test.
+HYPERRAM_WORDS = 1 << 22
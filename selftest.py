@@ -1,43 +1,144 @@
-from cynthion.selftest.registers import *
 from cynthion.selftest.gateware import SelftestDevice
-from cynthion.selftest.host import StandaloneTester
-from apollo_fpga.support.selftest import named_test
+from cynthion.selftest import gateware as base_gateware
+from luna.gateware.applets.speed_test import USBSpeedTestDevice, BULK_ENDPOINT_NUMBER
+from luna.gateware.platform.core import LUNAApolloPlatform
+from luna.usb2 import USBDevice, USBStreamInEndpoint, USBStreamOutEndpoint
+from apollo_fpga.gateware.advertiser import ApolloAdvertiser
 from luna.gateware.interface.i2c import I2CRegisterInterface
+from luna.gateware.interface.psram import HyperRAMInterface
+from luna.gateware.interface.ulpi import ULPIRegisterWindow
 from luna import top_level_cli
-from amaranth import Signal, Cat
+from amaranth import Elaboratable, Module, Signal, Cat, Mux, ClockSignal, ResetSignal, ResetInserter
+from amaranth.lib.cdc import FFSynchronizer
+from contextlib import contextmanager
+from types import SimpleNamespace
+from registers import *
 
-REGISTER_TARGET_TYPEC_CTL_ADDR  = 22
-REGISTER_TARGET_TYPEC_CTL_VALUE = 23
-REGISTER_AUX_TYPEC_CTL_ADDR     = 24
-REGISTER_AUX_TYPEC_CTL_VALUE    = 25
-REGISTER_PWR_MON_ADDR           = 26
-REGISTER_PWR_MON_VALUE          = 27
+# Product IDs of the speed test devices, and their OUT data error and
+# checked byte count registers, by PHY register window.
+SPEED_TEST_PHYS = {
+    REGISTER_CONTROL_ADDR: (0x0001, REGISTER_CONTROL_SPEED_ERRORS, REGISTER_CONTROL_SPEED_CHECKED),
+    REGISTER_AUX_ADDR:     (0x0002, REGISTER_AUX_SPEED_ERRORS,     REGISTER_AUX_SPEED_CHECKED),
+    REGISTER_TARGET_ADDR:  (0x0003, REGISTER_TARGET_SPEED_ERRORS,  REGISTER_TARGET_SPEED_CHECKED),
+}
 
-REGISTER_CON_VBUS_EN            = 28
-REGISTER_AUX_VBUS_EN            = 29
-REGISTER_PASS_CONTROL           = 30
-REGISTER_PASS_AUX               = 31
-REGISTER_PASS_TARGET_C          = 32
+# Cycles to hold the PHYs in reset when switching them between uses.
+PHY_RESET_CYCLES = 60
 
-REGISTER_AUX_SBU                = 33
-REGISTER_TARGET_SBU             = 34
+# Cycles per millisecond of the sync domain, in which the I2C interfaces run.
+SYNC_CYCLES_PER_MS = SELFTEST_CLOCK_FREQUENCIES["sync"] * 1000
 
-REGISTER_BUTTON_USER            = 35
+# Cycles to hold each PMOD loopback pattern before checking it.
+PMOD_BIST_HOLD_CYCLES = 8
 
-REGISTER_PMOD_A_OUT             = 36
-REGISTER_PMOD_B_IN              = 37
+# Length of each HyperRAM self-test burst, in 16-bit words, which keeps chip
+# select within the 4us allowed between refreshes.
+HYPERRAM_BURST_WORDS = 128
 
-REGISTER_SENSE_DP               = 38
-REGISTER_SENSE_DM               = 39
+# TARGET PHY configurations applied by the D+/D- sense sequencer, as ULPI
+# register writes: function control, OTG control, then register 0x39.
+DPDM_SENSE_CONFIGURATIONS = [
+    [(0x04, 0x41), (0x0A, 0x06), (0x39, 0x06)],  # D+/D- pulled low
+    [(0x04, 0x45), (0x0A, 0x04), (0x39, 0x04)],  # D+ pulled low, D- pulled high
+    [(0x04, 0x45), (0x0A, 0x04), (0x39, 0x06)],  # D+ pulled high, D- pulled low
+]
+
+# Cycles to let D+/D- settle after each configuration, in the USB domain.
+DPDM_SETTLE_CYCLES = SELFTEST_CLOCK_FREQUENCIES["usb"] * 1000
 
 
 class AssistedSelftestDevice(SelftestDevice):
 
     def elaborate(self, platform):
-        m = super().elaborate(platform)
+        # PHYs set up by add_ulpi_registers, to be shared with speed test devices.
+        self.shared_phys = []
+
+        # HyperRAM self-test, sharing the interface which the base design
+        # sets up for reading the RAM's registers.
+        ram_bist = HyperRAMBIST(words=HYPERRAM_WORDS, burst_words=HYPERRAM_BURST_WORDS)
+        def shared_ram_interface(*, phy):
+            return SharedHyperRAMInterface(phy=phy, bist=ram_bist)
+
+        # Build the base design with the clock frequencies the host assumes.
+        with replaced(base_gateware, "HyperRAMInterface", shared_ram_interface), \
+                replaced(base_gateware, "CLOCK_FREQUENCIES", SELFTEST_CLOCK_FREQUENCIES):
+            m = super().elaborate(platform)
 
         registers = m.submodules.registers
 
+        # HyperRAM self-test registers.
+        registers.add_sfr(REGISTER_RAM_BIST,
+            read=Cat(ram_bist.done, ram_bist.passed),
+            write_strobe=ram_bist.start,
+            write_signal=Signal())
+        registers.add_sfr(REGISTER_RAM_BIST_ERRORS, read=ram_bist.errors)
+        registers.add_sfr(REGISTER_RAM_BIST_FIRST_ERROR, read=ram_bist.first_error)
+        registers.add_sfr(REGISTER_RAM_BIST_WRITE_CYCLES, read=ram_bist.write_cycles)
+        registers.add_sfr(REGISTER_RAM_BIST_READ_CYCLES, read=ram_bist.read_cycles)
+
+        # D+/D- sense sequencer, which drives the TARGET PHY while it runs.
+        dpdm_sense = DPDMSenseSequencer(
+            configurations=DPDM_SENSE_CONFIGURATIONS,
+            settle_cyc=DPDM_SETTLE_CYCLES)
+        m.submodules.dpdm_sense = dpdm_sense
+        dpdm_sense_start = Signal()
+        registers.add_sfr(REGISTER_DPDM_SENSE,
+            read=Cat(dpdm_sense.results, dpdm_sense.done),
+            write_strobe=dpdm_sense_start,
+            write_signal=Signal())
+        m.submodules.clocking.stretch_sync_strobe_to_usb(m,
+            strobe=dpdm_sense_start,
+            output=dpdm_sense.start)
+
+        #
+        # Speed test devices
+        #
+        # Each PHY is driven either by its ULPI register window, or by a
+        # speed test device, selected by the speed test register. The speed
+        # test devices are held in reset while not selected, and the PHYs are
+        # reset on each change, so that neither starts from a PHY state left
+        # by the other.
+        #
+        speed_test_reg = registers.add_register(REGISTER_SPEED_TEST, size=1, reset=False)
+        speed_test = Signal()
+        m.submodules += FFSynchronizer(speed_test_reg, speed_test, o_domain="usb")
+
+        speed_test_last = Signal()
+        phy_reset = Signal(range(PHY_RESET_CYCLES + 1))
+        m.d.usb += speed_test_last.eq(speed_test)
+        with m.If(speed_test != speed_test_last):
+            m.d.usb += phy_reset.eq(PHY_RESET_CYCLES)
+        with m.Elif(phy_reset != 0):
+            m.d.usb += phy_reset.eq(phy_reset - 1)
+
+        for ulpi_bus, pads, window, register_base in self.shared_phys:
+            pid, errors_reg, checked_reg = SPEED_TEST_PHYS[register_base]
+            device = ulpi_signals()
+            speed_test_device = SharedSpeedTestDevice(device, phy_name=ulpi_bus, vid=0x1209, pid=pid)
+            m.submodules[f"{ulpi_bus}_speed_test"] = ResetInserter(
+                {"usb": ~speed_test, "sync": ~speed_test_reg})(speed_test_device)
+            # The counts only change during a speed test, when they are not read.
+            registers.add_sfr(errors_reg, read=speed_test_device.errors)
+            registers.add_sfr(checked_reg, read=speed_test_device.checked)
+            m.d.comb += [
+                pads.clk.o.eq(ClockSignal("usb")),
+                pads.rst.o.eq(ResetSignal("usb") | (phy_reset != 0)),
+            ]
+            sequenced = register_base == REGISTER_TARGET_ADDR
+            for bus in (window, device, dpdm_sense.ulpi) if sequenced else (window, device):
+                m.d.comb += [
+                    bus.data.i.eq(pads.data.i),
+                    bus.dir.i.eq(pads.dir.i),
+                    bus.nxt.i.eq(pads.nxt.i),
+                ]
+            with m.If(speed_test):
+                m.d.comb += driven_by(pads, device)
+            if sequenced:
+                with m.Elif(dpdm_sense.running):
+                    m.d.comb += driven_by(pads, dpdm_sense.ulpi)
+            with m.Else():
+                m.d.comb += driven_by(pads, window)
+
         # VBUS enable registers.
         con_vbus_reg = registers.add_register(REGISTER_CON_VBUS_EN, size=1, reset=True)
         aux_vbus_reg = registers.add_register(REGISTER_AUX_VBUS_EN, size=1, reset=True)
@@ -67,17 +168,40 @@ class AssistedSelftestDevice(SelftestDevice):
             dev_address=0b0100010,  # FUSB302BMPX slave address
             register_base=REGISTER_AUX_TYPEC_CTL_ADDR
         )
+        power_mon_poller = I2CPoller(
+            data_bytes=2,
+            refresh=0x1F,                   # REFRESH_V, leaving accumulators running
+            registers=range(0x07, 0x0F),    # VBUS1-4, then VSENSE1-4
+            interval_cyc=0,                 # poll back to back
+            settle_cyc=1 * SYNC_CYCLES_PER_MS,
+        )
         power_mon = self.add_i2c_registers(m, platform,
             i2c_bus="power_monitor",
             dev_address=0b0010000,  # PAC195X slave address when ADDRSEL tied to GND
             register_base=REGISTER_PWR_MON_ADDR,
-            data_bytes=2
+            data_bytes=2,
+            poller=power_mon_poller
         )
         m.d.comb += [
             power_mon.slow.o.eq(1),
             power_mon.pwrdn.o.eq(0),
         ]
 
+        # Power monitor polling registers. Reading the sample count latches
+        # the readings of the latest sample, so that the host can read any of
+        # them from the same sample afterwards.
+        pwr_mon_poll_reg = registers.add_register(REGISTER_PWR_MON_POLL, size=1, reset=False)
+        m.d.comb += power_mon_poller.enable.eq(pwr_mon_poll_reg)
+        pwr_mon_samples_read = Signal()
+        registers.add_sfr(REGISTER_PWR_MON_SAMPLES,
+            read=power_mon_poller.samples,
+            read_strobe=pwr_mon_samples_read)
+        for i, value in enumerate(power_mon_poller.values):
+            reading = Signal.like(value, name=f"pwr_mon_reading_{i}")
+            with m.If(pwr_mon_samples_read):
+                m.d.sync += reading.eq(value)
+            registers.add_sfr(REGISTER_PWR_MON_READINGS + i, read=reading)
+
         # SBU control registers.
         aux_sbu_reg = registers.add_register(REGISTER_AUX_SBU, size=2, reset=0)
         target_sbu_reg = registers.add_register(REGISTER_TARGET_SBU, size=2, reset=0)
@@ -104,72 +228,822 @@ class AssistedSelftestDevice(SelftestDevice):
         pmod_out = platform.request("user_pmod", 0, dir='o').o
         pmod_in = platform.request("user_pmod", 1, dir='i').i
         pmod_out_reg = registers.add_register(REGISTER_PMOD_A_OUT, size=8)
-        m.d.comb += pmod_out.eq(pmod_out_reg)
         registers.add_sfr(REGISTER_PMOD_B_IN, read=pmod_in)
 
+        # PMOD loopback self-test, driving PMOD A while it runs.
+        m.submodules.pmod_bist = pmod_bist = PMODLoopbackBIST(hold_cyc=PMOD_BIST_HOLD_CYCLES)
+        registers.add_sfr(REGISTER_PMOD_BIST,
+            read=Cat(pmod_bist.mismatch, pmod_bist.done, pmod_bist.passed),
+            write_strobe=pmod_bist.start,
+            write_signal=Signal())
+        m.d.comb += pmod_bist.pins_in.eq(pmod_in)
+        with m.If(pmod_bist.running):
+            m.d.comb += pmod_out.eq(pmod_bist.pins_out)
+        with m.Else():
+            m.d.comb += pmod_out.eq(pmod_out_reg)
+
         # D+/D- sense registers.
         usb_dp = platform.request("target_usb_dp", 0, dir='i').i
         usb_dm = platform.request("target_usb_dm", 0, dir='i').i
         registers.add_sfr(REGISTER_SENSE_DP, read=usb_dp)
         registers.add_sfr(REGISTER_SENSE_DM, read=usb_dm)
+        m.d.comb += [
+            dpdm_sense.dp.eq(usb_dp),
+            dpdm_sense.dm.eq(usb_dm),
+        ]
 
         return m
 
 
-    def add_i2c_registers(self, m, platform, *, i2c_bus, dev_address, register_base, data_bytes=1):
-        """ Adds a set of I2C registers to the active design. """
+    def add_ulpi_registers(self, m, platform, *, ulpi_bus, register_base):
+        """ Adds a set of ULPI registers, on a PHY shared with a speed test device. """
+
+        pads = platform.request(ulpi_bus)
+        window = ulpi_signals()
+        with substituted(platform, ulpi_bus, window):
+            super().add_ulpi_registers(m, platform,
+                ulpi_bus=ulpi_bus, register_base=register_base)
+        self.shared_phys.append((ulpi_bus, pads, window, register_base))
+
+
+    def add_i2c_registers(self, m, platform, *, i2c_bus, dev_address, register_base, data_bytes=1, poller=None):
+        """ Adds a set of I2C registers to the active design, optionally shared with a poller. """
 
         target_i2c = platform.request(i2c_bus, dir={'sbu1': 'o', 'sbu2': 'o', 'slow': 'o', 'pwrdn': 'o'})
         i2c_if     = I2CRegisterInterface(pads=target_i2c, period_cyc=300, address=dev_address, data_bytes=data_bytes)
         m.submodules += i2c_if
 
+        # Register accesses go through the poller, if there is one.
+        host_if = i2c_if
+        if poller is not None:
+            poller.interface = i2c_if
+            m.submodules += poller
+            host_if = poller
+
         register_address_change  = Signal()
         register_value_change    = Signal()
 
         reg_size                 = Signal(8)
-        m.d.comb += i2c_if.size.eq(reg_size)
+        m.d.comb += host_if.size.eq(reg_size)
 
         # I2C register address.
         registers = m.submodules.registers
         registers.add_register(register_base + 0,
             write_strobe=register_address_change,
-            value_signal=Cat(reg_size, i2c_if.address),  # 16-bit value: (address << 8) | size
+            value_signal=Cat(reg_size, host_if.address),  # 16-bit value: (address << 8) | size
         )
-        m.d.sync += i2c_if.read_request.eq(register_address_change)
+        m.d.sync += host_if.read_request.eq(register_address_change)
 
         # I2C register value.
         registers.add_sfr(register_base + 1,
-            read=i2c_if.read_data,
-            write_signal=i2c_if.write_data,
+            read=host_if.read_data,
+            write_signal=host_if.write_data,
             write_strobe=register_value_change
         )
-        m.d.sync += i2c_if.write_request.eq(register_value_change)
+        m.d.sync += host_if.write_request.eq(register_value_change)
 
         return target_i2c
 
 
-class AssistedTester(StandaloneTester):
-
-    @named_test("TARGET Type-C")
-    def test_target_typec_controller(self, dut):
-        self.dut.registers.register_write(REGISTER_TARGET_TYPEC_CTL_ADDR, (0x01 << 8) | 1)
-        actual_value = self.dut.registers.register_read(REGISTER_TARGET_TYPEC_CTL_VALUE)
-        if actual_value & 0b11001100 != 0b10000000:
-            raise AssertionError(f"TARGET Type-C ID device ID register was {bin(actual_value)}, not 0b10xx00xx")
-
-    @named_test("AUX Type-C")
-    def test_aux_typec_controller(self, dut):
-        self.dut.registers.register_write(REGISTER_AUX_TYPEC_CTL_ADDR, (0x01 << 8) | 1)
-        actual_value = self.dut.registers.register_read(REGISTER_AUX_TYPEC_CTL_VALUE)
-        if actual_value & 0b11001100 != 0b10000000:
-            raise AssertionError(f"TARGET Type-C ID device ID register was {bin(actual_value)}, not 0b10xx00xx")
-
-    @named_test("Power monitor")
-    def test_power_monitor_controller(self, dut):
-        self.dut.registers.register_write(REGISTER_PWR_MON_ADDR, (0xFE << 8) | 1)
-        actual_value = self.dut.registers.register_read(REGISTER_PWR_MON_VALUE)
-        if actual_value != 0x54:
-            raise AssertionError(f"Power Monitor manufacturer ID register 0x{actual_value:x} != 0x54")
+class I2CPoller(Elaboratable):
+    """ Polls registers of an I2C device, sharing its interface with register accesses.
+
+    While enabled, the poller waits for an interval, if any, writes the refresh
+    register. Once all have been read, it updates `values` together and
+    increments `samples`, so `values` always hold a single complete poll. A
+    poll in which any transaction fails is discarded and retried. Register
+    accesses from the host are made between the poller's transactions, with
+    their read data kept separately.
+
+    I/O ports:
+
+        I: enable            -- enables polling
+
+        O: samples[16]       -- count of completed polls
+        O: values            -- value of each polled register, from the latest poll
+
+        # Host register access, as for I2CRegisterInterface:
+        I: address[8], size[8], read_request, write_request, write_data
+        O: read_data
+    """
+
+    def __init__(self, *, data_bytes, refresh, registers, interval_cyc, settle_cyc):
+        self.interface     = None
+        self.data_bytes    = data_bytes
+        self.refresh       = refresh
+        self.registers     = list(registers)
+        self.interval_cyc  = interval_cyc
+        self.settle_cyc    = settle_cyc
+
+        self.enable        = Signal()
+        self.samples       = Signal(16)
+        self.values        = [Signal(8 * data_bytes, name=f"value_{reg:02x}") for reg in self.registers]
+
+        self.address       = Signal(8)
+        self.size          = Signal(8)
+        self.read_request  = Signal()
+        self.write_request = Signal()
+        self.write_data    = Signal(8 * data_bytes)
+        self.read_data     = Signal(8 * data_bytes)
+
+    def elaborate(self, platform):
+        m = Module()
+        i2c = self.interface
+
+        host_pending = Signal()
+        host_write   = Signal()
+
+        timer     = Signal(range(max(self.interval_cyc, self.settle_cyc) + 1))
+        index     = Signal(range(len(self.registers)))
+        reading   = Signal()
+        succeeded = Signal()
+
+        polled = [Signal(8 * self.data_bytes, name=f"polled_{reg:02x}") for reg in self.registers]
+
+        poll_address = Signal(8)
+        with m.Switch(index):
+            for i, register in enumerate(self.registers):
+                with m.Case(i):
+                    m.d.comb += poll_address.eq(register)
+
+        with m.FSM():
+
+            # IDLE: start the next transaction, host requests first.
+            with m.State("IDLE"):
+                with m.If(timer != 0):
+                    m.d.sync += timer.eq(timer - 1)
+
+                with m.If(host_pending):
+                    m.d.comb += [
+                        i2c.address       .eq(self.address),
+                        i2c.size          .eq(self.size),
+                        i2c.write_data    .eq(self.write_data),
+                        i2c.read_request  .eq(~host_write),
+                        i2c.write_request .eq(host_write),
+                    ]
+                    m.d.sync += [
+                        host_pending .eq(0),
+                        succeeded    .eq(0),
+                    ]
+                    m.next = "HOST"
+
+                with m.Elif(reading):
+                    m.d.comb += [
+                        i2c.address      .eq(poll_address),
+                        i2c.size         .eq(self.data_bytes),
+                        i2c.read_request .eq(1),
+                    ]
+                    m.d.sync += succeeded.eq(0)
+                    m.next = "POLL"
+
+                with m.Elif(self.enable & (timer == 0)):
+                    m.d.comb += [
+                        i2c.address       .eq(self.refresh),
+                        i2c.size          .eq(0),
+                        i2c.write_request .eq(1),
+                    ]
+                    m.d.sync += [
+                        succeeded .eq(0),
+                        timer     .eq(self.settle_cyc),
+                    ]
+                    m.next = "REFRESH"
+
+            # HOST: wait for a host request to complete.
+            with m.State("HOST"):
+                with m.If(i2c.done):
+                    m.d.sync += succeeded.eq(1)
+                    with m.If(~host_write):
+                        m.d.sync += self.read_data.eq(i2c.read_data)
+                with m.If(~i2c.busy):
+                    m.next = "IDLE"
+
+            # REFRESH: wait for the refresh to complete, then settle and read.
+            with m.State("REFRESH"):
+                with m.If(i2c.done):
+                    m.d.sync += [
+                        reading .eq(1),
+                        index   .eq(0),
+                    ]
+                with m.If(~i2c.busy):
+                    m.next = "SETTLE"
+
+            # SETTLE: wait for the device's readings to be ready.
+            with m.State("SETTLE"):
+                with m.If(timer != 0):
+                    m.d.sync += timer.eq(timer - 1)
+                with m.Else():
+                    with m.If(~reading):
+                        # Refresh failed; try again after an interval.
+                        m.d.sync += timer.eq(self.interval_cyc)
+                    m.next = "IDLE"
+
+            # POLL: wait for a polled register read to complete.
+            with m.State("POLL"):
+                with m.If(i2c.done):
+                    m.d.sync += succeeded.eq(1)
+                    with m.Switch(index):
+                        for i, value in enumerate(polled):
+                            with m.Case(i):
+                                m.d.sync += value.eq(i2c.read_data)
+                with m.If(~i2c.busy):
+                    with m.If(~succeeded):
+                        # Read failed; discard this poll.
+                        m.d.sync += [
+                            reading .eq(0),
+                            timer   .eq(self.interval_cyc),
+                        ]
+                    with m.Elif(index == len(self.registers) - 1):
+                        # Poll complete; latch its readings together.
+                        m.d.sync += [
+                            reading      .eq(0),
+                            timer        .eq(self.interval_cyc),
+                            self.samples .eq(self.samples + 1),
+                        ]
+                        m.d.sync += [value.eq(read) for value, read in zip(self.values, polled)]
+                    with m.Else():
+                        m.d.sync += index.eq(index + 1)
+                    m.next = "IDLE"
+
+        # Host requests, held until the interface is free. A request made as
+        # the previous one is started takes priority over clearing it.
+        with m.If(self.read_request | self.write_request):
+            m.d.sync += [
+                host_pending .eq(1),
+                host_write   .eq(self.write_request),
+            ]
+
+        return m
+
+
+class PMODLoopbackBIST(Elaboratable):
+    """ Checks a loopback from one PMOD port to another, at full fabric speed.
+
+    When started, drives a sequence of patterns on the outputs, and compares
+    the inputs against each one after holding it for `hold_cyc` cycles. The
+    sequence is walking ones, walking zeros, then all 255 values of an 8-bit
+    PRBS. The bits on which the inputs ever differed are latched in
+    `mismatch` until the next start.
+
+    I/O ports:
+
+        I: start             -- starts the test
+        I: pins_in[8]        -- looped-back inputs
+
+        O: pins_out[8]       -- pattern to drive on the outputs
+        O: running           -- high while the outputs should be driven
+        O: done              -- high once a test has completed
+        O: passed            -- high if the completed test found no mismatches
+        O: mismatch[8]       -- bits which differed from the expected pattern
+    """
+
+    # Walking ones, walking zeros, then the PRBS.
+    STEPS = 8 + 8 + 255
+
+    def __init__(self, *, hold_cyc):
+        self.hold_cyc  = hold_cyc
+
+        self.start     = Signal()
+        self.pins_in   = Signal(8)
+
+        self.pins_out  = Signal(8)
+        self.running   = Signal()
+        self.done      = Signal()
+        self.passed    = Signal()
+        self.mismatch  = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pins_in = Signal(8)
+        m.submodules += FFSynchronizer(self.pins_in, pins_in)
+
+        pattern = Signal(8)
+        hold    = Signal(range(self.hold_cyc))
+        step    = Signal(range(self.STEPS))
+
+        m.d.comb += [
+            self.pins_out .eq(pattern),
+            self.passed   .eq(self.done & (self.mismatch == 0)),
+        ]
+
+        with m.FSM():
+
+            # IDLE: wait to be started.
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        pattern       .eq(0x01),
+                        hold          .eq(self.hold_cyc - 1),
+                        step          .eq(0),
+                        self.done     .eq(0),
+                        self.mismatch .eq(0),
+                    ]
+                    m.next = "RUN"
+
+            # RUN: hold each pattern, then check it and move to the next.
+            with m.State("RUN"):
+                m.d.comb += self.running.eq(1)
+                with m.If(hold != 0):
+                    m.d.sync += hold.eq(hold - 1)
+                with m.Else():
+                    m.d.sync += [
+                        self.mismatch .eq(self.mismatch | (pins_in ^ pattern)),
+                        hold          .eq(self.hold_cyc - 1),
+                        step          .eq(step + 1),
+                    ]
+                    with m.If(step == 7):
+                        m.d.sync += pattern.eq(0xFE)
+                    with m.Elif(step == 15):
+                        m.d.sync += pattern.eq(0x01)
+                    with m.Elif(step < 15):
+                        # Rotate the walking bit along.
+                        m.d.sync += pattern.eq(Cat(pattern[7], pattern[:7]))
+                    with m.Else():
+                        # PRBS from x^8 + x^6 + x^5 + x^4 + 1.
+                        m.d.sync += pattern.eq(Cat(
+                            pattern[7] ^ pattern[5] ^ pattern[4] ^ pattern[3],
+                            pattern[:7]))
+                    with m.If(step == self.STEPS - 1):
+                        m.d.sync += self.done.eq(1)
+                        m.next = "IDLE"
+
+        return m
+
+
+class HyperRAMBIST(Elaboratable):
+    """ Tests the whole of a HyperRAM, in bursts, and measures its bandwidth.
+
+    When started, makes two passes over the RAM, each writing every word and
+    then reading every word back. The first pass writes a pattern derived
+    from each word's address, to find address faults; the second writes a
+    16-bit PRBS. Mismatched reads are counted in `errors`, and the address
+    of the first is kept in `first_error`. The cycles taken by the second
+    pass's writes and reads are kept in `write_cycles` and `read_cycles`.
+
+    I/O ports:
+
+        I: start             -- starts the test
+
+        O: running           -- high while the test is using the interface
+        O: done              -- high once a test has completed
+        O: passed            -- high if the completed test found no errors
+        O: errors[32]        -- count of words read back wrongly
+        O: first_error[32]   -- address of the first word read back wrongly
+        O: write_cycles[32]  -- cycles taken to write the whole RAM
+        O: read_cycles[32]   -- cycles taken to read the whole RAM
+
+        # Connection to a HyperRAMInterface, with the same names as its ports:
+        O: address[32], perform_write, start_transfer, final_word, write_data[16]
+        I: idle, read_ready, write_ready, read_data[16]
+    """
+
+    PASSES = ("ADDRESS", "PRBS")
+
+    def __init__(self, *, words, burst_words):
+        self.words          = words
+        self.burst_words    = burst_words
+
+        self.start          = Signal()
+
+        self.running        = Signal()
+        self.done           = Signal()
+        self.passed         = Signal()
+        self.errors         = Signal(32)
+        self.first_error    = Signal(32)
+        self.write_cycles   = Signal(32)
+        self.read_cycles    = Signal(32)
+
+        self.address        = Signal(32)
+        self.perform_write  = Signal()
+        self.start_transfer = Signal()
+        self.final_word     = Signal()
+        self.write_data     = Signal(16)
+        self.idle           = Signal()
+        self.read_ready     = Signal()
+        self.write_ready    = Signal()
+        self.read_data      = Signal(16)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        address   = Signal(range(self.words))
+        remaining = Signal(range(self.burst_words))
+        prbs_pass = Signal()
+        writing   = Signal()
+        prbs      = Signal(16)
+
+        # Expected contents of the current word.
+        pattern = Signal(16)
+        with m.If(prbs_pass):
+            m.d.comb += pattern.eq(prbs)
+        with m.Else():
+            m.d.comb += pattern.eq(address[:16] ^ address[16:])
+
+        m.d.comb += [
+            self.address       .eq(address),
+            self.perform_write .eq(writing),
+            self.write_data    .eq(pattern),
+            self.final_word    .eq(remaining == 0),
+            self.passed        .eq(self.done & (self.errors == 0)),
+        ]
+
+        with m.If(self.running & prbs_pass):
+            with m.If(writing):
+                m.d.sync += self.write_cycles.eq(self.write_cycles + 1)
+            with m.Else():
+                m.d.sync += self.read_cycles.eq(self.read_cycles + 1)
+
+        # Advance to the next word, and if it ends a burst, to the next burst.
+        advance = Signal()
+        with m.If(advance):
+            m.d.sync += [
+                address   .eq(address + 1),
+                remaining .eq(remaining - 1),
+                # PRBS from x^16 + x^15 + x^13 + x^4 + 1.
+                prbs      .eq(Cat(prbs[15] ^ prbs[14] ^ prbs[12] ^ prbs[3], prbs[:15])),
+            ]
+
+        with m.FSM():
+
+            # IDLE: wait to be started.
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        address           .eq(0),
+                        prbs              .eq(1),
+                        prbs_pass         .eq(0),
+                        writing           .eq(1),
+                        self.done         .eq(0),
+                        self.errors       .eq(0),
+                        self.first_error  .eq(0),
+                        self.write_cycles .eq(0),
+                        self.read_cycles  .eq(0),
+                    ]
+                    m.next = "WAIT"
+
+            # WAIT: let any transfer in progress for the host complete.
+            with m.State("WAIT"):
+                with m.If(self.idle):
+                    m.next = "START"
+
+            # START: start a burst at the current address.
+            with m.State("START"):
+                m.d.comb += self.running.eq(1)
+                with m.If(self.idle):
+                    m.d.comb += self.start_transfer.eq(1)
+                    m.d.sync += remaining.eq(self.burst_words - 1)
+                    m.next = "TRANSFER"
+
+            # TRANSFER: write or check each word of the burst.
+            with m.State("TRANSFER"):
+                m.d.comb += self.running.eq(1)
+                with m.If(writing):
+                    m.d.comb += advance.eq(self.write_ready)
+                with m.Else():
+                    m.d.comb += advance.eq(self.read_ready)
+                    with m.If(self.read_ready & (self.read_data != pattern)):
+                        m.d.sync += self.errors.eq(self.errors + 1)
+                        with m.If(self.errors == 0):
+                            m.d.sync += self.first_error.eq(address)
+                with m.If(advance & self.final_word):
+                    with m.If(address == self.words - 1):
+                        m.next = "NEXT"
+                    with m.Else():
+                        m.next = "START"
+
+            # NEXT: read back what was written, or move to the next pass.
+            with m.State("NEXT"):
+                m.d.comb += self.running.eq(1)
+                m.d.sync += [
+                    address .eq(0),
+                    prbs    .eq(1),
+                    writing .eq(~writing),
+                ]
+                with m.If(writing):
+                    m.next = "START"
+                with m.Elif(~prbs_pass):
+                    m.d.sync += prbs_pass.eq(1)
+                    m.next = "START"
+                with m.Else():
+                    m.d.sync += self.done.eq(1)
+                    m.next = "IDLE"
+
+        return m
+
+
+class SharedHyperRAMInterface(Elaboratable):
+    """ HyperRAM interface for the base design, shared with a self-test.
+
+    Has the same ports as HyperRAMInterface. These control the RAM except
+    while the self-test is running.
+    """
+
+    INPUTS = ("address", "register_space", "perform_write", "single_page",
+        "start_transfer", "final_word", "write_data")
+    OUTPUTS = ("idle", "read_ready", "write_ready", "read_data")
+
+    def __init__(self, *, phy, bist):
+        self.interface = HyperRAMInterface(phy=phy)
+        self.bist = bist
+        for name in self.INPUTS + self.OUTPUTS:
+            setattr(self, name, Signal.like(getattr(self.interface, name)))
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.interface = interface = self.interface
+        m.submodules.bist = bist = self.bist
+
+        with m.If(bist.running):
+            m.d.comb += [
+                interface.address        .eq(bist.address),
+                interface.register_space .eq(0),
+                interface.perform_write  .eq(bist.perform_write),
+                interface.single_page    .eq(0),
+                interface.start_transfer .eq(bist.start_transfer),
+                interface.final_word     .eq(bist.final_word),
+                interface.write_data     .eq(bist.write_data),
+            ]
+        with m.Else():
+            m.d.comb += [getattr(interface, name).eq(getattr(self, name))
+                for name in self.INPUTS]
+
+        m.d.comb += [
+            bist.idle        .eq(interface.idle),
+            bist.read_ready  .eq(interface.read_ready & bist.running),
+            bist.write_ready .eq(interface.write_ready & bist.running),
+            bist.read_data   .eq(interface.read_data),
+            self.idle        .eq(interface.idle & ~bist.running),
+            self.read_ready  .eq(interface.read_ready & ~bist.running),
+            self.write_ready .eq(interface.write_ready & ~bist.running),
+            self.read_data   .eq(interface.read_data),
+        ]
+
+        return m
+
+
+class DPDMSenseSequencer(Elaboratable):
+    """ Applies PHY configurations in turn, sampling D+/D- after each.
+
+    When started, makes each configuration's ULPI register writes through
+    its own register window, waits `settle_cyc` cycles, then samples the
+    D+/D- sense inputs. Runs in the USB domain.
+
+    I/O ports:
+
+        I: start             -- starts the sequence
+        I: dp, dm            -- D+/D- sense inputs
+
+        O: running           -- high while the sequencer is driving the PHY
+        O: done              -- high once a sequence has completed
+        O: results           -- D+ then D- level after each configuration
+
+        B: ulpi              -- ULPI signals for the PHY, as from ulpi_signals()
+    """
+
+    def __init__(self, *, configurations, settle_cyc):
+        self.configurations = configurations
+        self.settle_cyc     = settle_cyc
+
+        self.start          = Signal()
+        self.dp             = Signal()
+        self.dm             = Signal()
+
+        self.running        = Signal()
+        self.done           = Signal()
+        self.results        = Signal(2 * len(configurations))
+
+        self.ulpi           = ulpi_signals()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.window = window = ULPIRegisterWindow()
+        m.d.comb += [
+            window.ulpi_data_in  .eq(self.ulpi.data.i),
+            window.ulpi_dir      .eq(self.ulpi.dir.i),
+            window.ulpi_next     .eq(self.ulpi.nxt.i),
+            self.ulpi.stp.o      .eq(window.ulpi_stop),
+            self.ulpi.data.o     .eq(window.ulpi_data_out),
+            self.ulpi.data.oe    .eq(~self.ulpi.dir.i),
+        ]
+
+        dp = Signal()
+        dm = Signal()
+        m.submodules += [
+            FFSynchronizer(self.dp, dp, o_domain="usb"),
+            FFSynchronizer(self.dm, dm, o_domain="usb"),
+        ]
+
+        # All the register writes in order, noting which end a configuration.
+        writes = [(address, value, index == len(configuration) - 1)
+            for configuration in self.configurations
+            for index, (address, value) in enumerate(configuration)]
+
+        step   = Signal(range(len(writes)))
+        config = Signal(range(len(self.configurations)))
+        last   = Signal()
+        timer  = Signal(range(self.settle_cyc + 1))
+
+        with m.Switch(step):
+            for i, (address, value, ends_config) in enumerate(writes):
+                with m.Case(i):
+                    m.d.comb += [
+                        window.address    .eq(address),
+                        window.write_data .eq(value),
+                        last              .eq(ends_config),
+                    ]
+
+        with m.FSM(domain="usb"):
+
+            # IDLE: wait to be started.
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.usb += [
+                        step      .eq(0),
+                        config    .eq(0),
+                        self.done .eq(0),
+                    ]
+                    m.next = "WRITE"
+
+            # WRITE: start the next register write.
+            with m.State("WRITE"):
+                m.d.comb += self.running.eq(1)
+                with m.If(~window.busy):
+                    m.d.comb += window.write_request.eq(1)
+                    m.next = "WAIT"
+
+            # WAIT: wait for the write, then settle if it ends a configuration.
+            with m.State("WAIT"):
+                m.d.comb += self.running.eq(1)
+                with m.If(window.done):
+                    m.d.usb += step.eq(step + 1)
+                    with m.If(last):
+                        m.d.usb += timer.eq(self.settle_cyc)
+                        m.next = "SETTLE"
+                    with m.Else():
+                        m.next = "WRITE"
+
+            # SETTLE: let D+/D- settle, then sample them.
+            with m.State("SETTLE"):
+                m.d.comb += self.running.eq(1)
+                with m.If(timer != 0):
+                    m.d.usb += timer.eq(timer - 1)
+                with m.Else():
+                    with m.Switch(config):
+                        for i in range(len(self.configurations)):
+                            with m.Case(i):
+                                m.d.usb += self.results[2 * i:2 * i + 2].eq(Cat(dp, dm))
+                    with m.If(config == len(self.configurations) - 1):
+                        m.d.usb += self.done.eq(1)
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.usb += config.eq(config + 1)
+                        m.next = "WRITE"
+
+        return m
+
+
+class SharedSpeedTestDevice(USBSpeedTestDevice):
+    """ Speed test device for a PHY that is shared with its register window.
+
+    Unlike LUNA's speed test device, the IN endpoint sends a PRBS15 byte
+    stream, which the host checks, and data from the host on the OUT
+    endpoint is checked against the same sequence.
+
+    The OUT checker is self-synchronising: each byte is predicted from the
+    previous two received. After the first two bytes, each byte is counted
+    in `checked`, and in `errors` if it was not as predicted. A single bit
+    error is counted up to three times.
+    """
+
+    def __init__(self, bus, **kwargs):
+        super().__init__(generate_clocks=False, **kwargs)
+        self.bus      = bus
+        self.errors   = Signal(32)
+        self.checked  = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if isinstance(platform, LUNAApolloPlatform):
+            sharing = platform.port_sharing(self.phy_name)
+        else:
+            sharing = None
+
+        m.submodules.usb = usb = USBDevice(bus=self.bus)
+
+        descriptors = self.create_descriptors(sharing)
+        control_ep = usb.add_standard_control_endpoint(descriptors)
+
+        # The advertiser assumes the platform's default clocks, which the
+        # self-test gateware does not use.
+        if sharing == "advertising":
+            adv = m.submodules.adv = ApolloAdvertiser()
+            adv.clk_freq_hz = SELFTEST_CLOCK_HZ
+            control_ep.add_request_handler(adv.default_request_handler(1))
+
+        # Send the PRBS on the IN endpoint, as fast as the host accepts it.
+        stream_in_ep = USBStreamInEndpoint(
+            endpoint_number=BULK_ENDPOINT_NUMBER,
+            max_packet_size=self.max_bulk_packet_size
+        )
+        usb.add_endpoint(stream_in_ep)
+
+        tx_state = Signal(15)
+        tx_byte, tx_next = prbs15_byte(Mux(tx_state == 0, 1, tx_state))
+        m.d.comb += [
+            stream_in_ep.stream.valid    .eq(1),
+            stream_in_ep.stream.payload  .eq(tx_byte),
+        ]
+        with m.If(stream_in_ep.stream.ready):
+            m.d.usb += tx_state.eq(tx_next)
+
+        # Check the data received on the OUT endpoint.
+        stream_out_ep = USBStreamOutEndpoint(
+            endpoint_number=BULK_ENDPOINT_NUMBER,
+            max_packet_size=self.max_bulk_packet_size
+        )
+        usb.add_endpoint(stream_out_ep)
+
+        rx = stream_out_ep.stream
+        rx_state = Signal(15)
+        rx_primed = Signal(range(3))
+        rx_expected, _ = prbs15_byte(rx_state)
+        m.d.comb += rx.ready.eq(1)
+        with m.If(rx.valid):
+            m.d.usb += rx_state.eq(Cat(rx_state, rx.payload)[8:])
+            with m.If(rx_primed != 2):
+                m.d.usb += rx_primed.eq(rx_primed + 1)
+            with m.Else():
+                m.d.usb += self.checked.eq(self.checked + 1)
+                with m.If(rx.payload != rx_expected):
+                    m.d.usb += self.errors.eq(self.errors + 1)
+
+        m.d.comb += [
+            usb.connect          .eq(1),
+            usb.full_speed_only  .eq(0),
+        ]
+
+        return m
+
+
+def prbs15_byte(state):
+    """ Returns the PRBS15 byte following the given 15 bits, and the state after it.
+
+    The sequence is x^15 + x^14 + 1, with the bits of each byte sent LSB
+    first, and the state holding the most recent bit in its MSB.
+    """
+    bits = [state[i] for i in range(15)]
+    for _ in range(8):
+        bits.append(bits[-15] ^ bits[-14])
+    return Cat(*bits[15:]), Cat(*bits[8:])
+
+
+def ulpi_signals():
+    """ Returns signals laid out like a ULPI resource, for connecting to the pads. """
+    return SimpleNamespace(
+        data=SimpleNamespace(i=Signal(8), o=Signal(8), oe=Signal()),
+        clk=SimpleNamespace(o=Signal()),
+        dir=SimpleNamespace(i=Signal()),
+        nxt=SimpleNamespace(i=Signal()),
+        stp=SimpleNamespace(o=Signal()),
+        rst=SimpleNamespace(o=Signal()))
+
+
+def driven_by(pads, bus):
+    """ Returns statements driving the outputs of ULPI pads from a bus. """
+    return [
+        pads.data.o.eq(bus.data.o),
+        pads.data.oe.eq(bus.data.oe),
+        pads.stp.o.eq(bus.stp.o),
+    ]
+
+
+@contextmanager
+def substituted(platform, name, bus):
+    """ Makes the platform return the given signals when a resource is requested. """
+    request = platform.request
+    def substitute(resource, *args, **kwargs):
+        if resource == name:
+            return bus
+        return request(resource, *args, **kwargs)
+    platform.request = substitute
+    try:
+        yield
+    finally:
+        del platform.request
+
+
+@contextmanager
+def replaced(module, name, replacement):
+    """ Makes a module use a replacement for one of its global names. """
+    original = getattr(module, name)
+    setattr(module, name, replacement)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
 
 if __name__ == "__main__":
     tester = top_level_cli(AssistedSelftestDevice)
@@ -0,0 +1,27 @@
+from cynthion.selftest.host import StandaloneTester
+from apollo_fpga.support.selftest import named_test
+from registers import *
+
+
+class AssistedTester(StandaloneTester):
+
+    @named_test("TARGET Type-C")
+    def test_target_typec_controller(self, dut):
+        self.dut.registers.register_write(REGISTER_TARGET_TYPEC_CTL_ADDR, (0x01 << 8) | 1)
+        actual_value = self.dut.registers.register_read(REGISTER_TARGET_TYPEC_CTL_VALUE)
+        if actual_value & 0b11001100 != 0b10000000:
+            raise AssertionError(f"TARGET Type-C ID device ID register was {bin(actual_value)}, not 0b10xx00xx")
+
+    @named_test("AUX Type-C")
+    def test_aux_typec_controller(self, dut):
+        self.dut.registers.register_write(REGISTER_AUX_TYPEC_CTL_ADDR, (0x01 << 8) | 1)
+        actual_value = self.dut.registers.register_read(REGISTER_AUX_TYPEC_CTL_VALUE)
+        if actual_value & 0b11001100 != 0b10000000:
+            raise AssertionError(f"TARGET Type-C ID device ID register was {bin(actual_value)}, not 0b10xx00xx")
+
+    @named_test("Power monitor")
+    def test_power_monitor_controller(self, dut):
+        self.dut.registers.register_write(REGISTER_PWR_MON_ADDR, (0xFE << 8) | 1)
+        actual_value = self.dut.registers.register_read(REGISTER_PWR_MON_VALUE)
+        if actual_value != 0x54:
+            raise AssertionError(f"Power Monitor manufacturer ID register 0x{actual_value:x} != 0x54")
@@ -20,6 +20,10 @@ class TPS55288(I2CRegisterBasedDevice):
         with error_conversion(GF1Error):
             return super().write(reg, value)
 
+    def responding(self):
+        # CDC register reset value.
+        return self.read(CDC) == 0b11100000
+
     def disable(self):
         self.write(MODE, 0x20)
 
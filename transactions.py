@@ -0,0 +1,320 @@
+# Recording and replay of hardware transactions.
+#
+# During a recorded run, every call into the hardware libraries (GreatFET,
+# Apollo, flash bridge, libusb devices and handles, external commands) is
+# captured with its result and timestamp, to a compact binary trace. The
+# trace can later be replayed to re-run the same test sequence offline and
+# at full speed, with the recorded results fed back to the test code. This
+# allows intermittent failures to be reproduced, and changes to test limits
+# to be checked against recorded units.
+#
+# Select with environment variables when running cynthion-test.py:
+#
+#   CYNTHION_TEST_RECORD  Trace file to record to.
+#   CYNTHION_TEST_REPLAY  Trace file to replay from.
+#
+# Reading calibration and checking installed dependencies are also recorded,
+# so a trace can be replayed on a host without the original tester's files.
+#
+# The trace is a gzip stream of length-prefixed marshal records, each of:
+#
+#   (time, stream, path, kind, value)
+#
+# Each object returned by the hardware libraries is named by its stream
+# and a sequence number, e.g. "GreatFET#3", and the path gives the method
+# or attribute used, e.g. "GreatFET#3.adc.read_samples". Calls into each
+# stream are replayed in the order recorded; separate streams may have been
+# called concurrently from different threads.
+
+from contextlib import contextmanager
+from errors import ReplayError
+from time import time
+import array
+import gzip
+import importlib
+import marshal
+import os
+import struct
+import threading
+
+VERSION = 1
+
+# Names patched in the test modules. Each is the root of its own stream.
+ROOTS = (
+    'GreatFET',
+    'ButtonWatcher',
+    'ApolloDebugger',
+    'FlashBridgeConnection',
+    'ECP5FlashBridgeProgrammer',
+    'wait_for_device',
+    'pyusb_device',
+    'present_device',
+    'run_command',
+    'start_command',
+    'test_usb_hs_speed_single',
+    'installed',
+    'installed_udev_rules',
+    'read_calibration',
+    'load_legacy_calibration',
+    'log_drift',
+)
+
+def is_value(value):
+    try:
+        marshal.dumps(value)
+        return True
+    except ValueError:
+        return False
+
+def encode(value, stream):
+    """ Encodes a result for the trace, naming any objects in a stream. """
+    if isinstance(value, (list, tuple)):
+        return ('l' if isinstance(value, list) else 't',
+            [encode(item, stream) for item in value])
+    if isinstance(value, array.array):
+        value = value.tolist()
+    if is_value(value):
+        return ('v', value)
+    return ('o', stream.wrap(value))
+
+def unwrap(value):
+    if isinstance(value, RecordingProxy):
+        return object.__getattribute__(value, 'target')
+    return value
+
+class Stream:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.objects = 0
+        self.records = []
+
+    def wrap(self, target):
+        self.objects += 1
+        name = f"{self.name}#{self.objects}"
+        return RecordingProxy(target, self, name)
+
+class Recorder:
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wb')
+        self.lock = threading.Lock()
+        self.start = time()
+        self.streams = {}
+        self.write(('header', VERSION, self.start))
+
+    def stream(self, name):
+        if name not in self.streams:
+            self.streams[name] = Stream(self, name)
+        return self.streams[name]
+
+    def record(self, stream, path, kind, value):
+        self.write((time() - self.start, stream.name, path, kind, value))
+
+    def write(self, record):
+        data = marshal.dumps(record)
+        with self.lock:
+            self.file.write(struct.pack('<I', len(data)) + data)
+
+    def close(self):
+        self.file.close()
+
+class RecordingProxy:
+    def __init__(self, target, stream, path):
+        object.__setattr__(self, 'target', target)
+        object.__setattr__(self, 'stream', stream)
+        object.__setattr__(self, 'path', path)
+
+    def __getattr__(self, name):
+        target = object.__getattribute__(self, 'target')
+        stream = object.__getattribute__(self, 'stream')
+        path = object.__getattribute__(self, 'path') + '.' + name
+        value = getattr(target, name)
+        if not callable(value) and is_value(value):
+            stream.trace.record(stream, path, 'attr', value)
+            return value
+        return RecordingProxy(value, stream, path)
+
+    def __setattr__(self, name, value):
+        setattr(object.__getattribute__(self, 'target'), name, unwrap(value))
+
+    def __call__(self, *args, **kwargs):
+        target = object.__getattribute__(self, 'target')
+        stream = object.__getattribute__(self, 'stream')
+        path = object.__getattribute__(self, 'path')
+        args = [unwrap(arg) for arg in args]
+        kwargs = {key: unwrap(value) for key, value in kwargs.items()}
+        try:
+            result = target(*args, **kwargs)
+        except Exception as error:
+            cls = type(error)
+            error_args = error.args if is_value(error.args) else (str(error),)
+            stream.trace.record(stream, path, 'raise',
+                (cls.__module__, cls.__qualname__, error_args))
+            raise
+        encoded = encode(result, stream)
+        stream.trace.record(stream, path, 'return', unwrap_encoded(encoded))
+        return decode_recorded(encoded)
+
+    def __enter__(self):
+        return self.__getattr__('__enter__')()
+
+    def __exit__(self, *exc_info):
+        return self.__getattr__('__exit__')(*exc_info)
+
+def unwrap_encoded(encoded):
+    # Replace proxies in an encoded result with their names.
+    kind, value = encoded
+    if kind == 'o':
+        return (kind, object.__getattribute__(value, 'path'))
+    if kind in ('l', 't'):
+        return (kind, [unwrap_encoded(item) for item in value])
+    return encoded
+
+def decode_recorded(encoded):
+    kind, value = encoded
+    if kind == 'l':
+        return [decode_recorded(item) for item in value]
+    if kind == 't':
+        return tuple(decode_recorded(item) for item in value)
+    return value
+
+class Replayer:
+    def __init__(self, path):
+        self.streams = {}
+        self.lock = threading.Lock()
+        with gzip.open(path, 'rb') as file:
+            header = self.read(file)
+            if header is None or header[0] != 'header' or header[1] != VERSION:
+                raise ReplayError(f"{path} is not a version {VERSION} trace")
+            while (record := self.read(file)) is not None:
+                stamp, stream, path, kind, value = record
+                self.streams.setdefault(stream, []).append(record)
+        # Consume records from the front of each stream.
+        for records in self.streams.values():
+            records.reverse()
+
+    @staticmethod
+    def read(file):
+        if len(prefix := file.read(4)) < 4:
+            return None
+        length, = struct.unpack('<I', prefix)
+        return marshal.loads(file.read(length))
+
+    def peek(self, stream):
+        with self.lock:
+            records = self.streams.get(stream)
+            return records[-1] if records else None
+
+    def next(self, stream, path):
+        with self.lock:
+            records = self.streams.get(stream)
+            if not records:
+                raise ReplayError(f"Trace ended before call to {path}")
+            record = records.pop()
+        if record[2] != path:
+            raise ReplayError(
+                f"Replay diverged from trace: called {path}, "
+                f"trace has {record[2]}")
+        return record
+
+    def decode(self, stream, encoded):
+        kind, value = encoded
+        if kind == 'o':
+            return ReplayProxy(self, stream, value)
+        if kind == 'l':
+            return [self.decode(stream, item) for item in value]
+        if kind == 't':
+            return tuple(self.decode(stream, item) for item in value)
+        return value
+
+class ReplayProxy:
+    def __init__(self, replayer, stream, path):
+        object.__setattr__(self, 'replayer', replayer)
+        object.__setattr__(self, 'stream', stream)
+        object.__setattr__(self, 'path', path)
+
+    def __getattr__(self, name):
+        replayer = object.__getattribute__(self, 'replayer')
+        stream = object.__getattribute__(self, 'stream')
+        path = object.__getattribute__(self, 'path') + '.' + name
+        record = replayer.peek(stream)
+        if record is not None and record[2] == path and record[3] == 'attr':
+            return replayer.next(stream, path)[4]
+        return ReplayProxy(replayer, stream, path)
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        replayer = object.__getattribute__(self, 'replayer')
+        stream = object.__getattribute__(self, 'stream')
+        path = object.__getattribute__(self, 'path')
+        stamp, _, _, kind, value = replayer.next(stream, path)
+        if kind == 'raise':
+            raise rebuild_exception(*value)
+        if kind != 'return':
+            raise ReplayError(f"Replay diverged from trace: called {path}, "
+                              f"trace has {kind} of it")
+        return replayer.decode(stream, value)
+
+    def __enter__(self):
+        return self.__getattr__('__enter__')()
+
+    def __exit__(self, *exc_info):
+        return self.__getattr__('__exit__')(*exc_info)
+
+def rebuild_exception(module, qualname, args):
+    try:
+        cls = importlib.import_module(module)
+        for name in qualname.split('.'):
+            cls = getattr(cls, name)
+        return cls(*args)
+    except Exception:
+        return ReplayError(f"Recorded {module}.{qualname}: {args}")
+
+@contextmanager
+def patched(modules, replacements):
+    saved = []
+    for module in modules:
+        for name, value in replacements.items():
+            if name in module.__dict__:
+                saved.append((module, name, module.__dict__[name]))
+                setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in reversed(saved):
+            setattr(module, name, value)
+
+@contextmanager
+def recording(path, modules):
+    """ Records hardware transactions made through the given modules. """
+    recorder = Recorder(path)
+    roots = modules[0].__dict__
+    replacements = {name: RecordingProxy(roots[name], recorder.stream(name), name)
+        for name in ROOTS}
+    try:
+        with patched(modules, replacements):
+            yield recorder
+    finally:
+        recorder.close()
+
+@contextmanager
+def replaying(path, modules):
+    """ Replays hardware transactions from a trace, without delays. """
+    replayer = Replayer(path)
+    replacements = {name: ReplayProxy(replayer, name, name) for name in ROOTS}
+    replacements['sleep'] = lambda seconds: None
+    with patched(modules, replacements):
+        yield replayer
+
+@contextmanager
+def from_environment(modules):
+    if path := os.environ.get('CYNTHION_TEST_REPLAY'):
+        with replaying(path, modules):
+            yield
+    elif path := os.environ.get('CYNTHION_TEST_RECORD'):
+        with recording(path, modules):
+            yield
+    else:
+        yield